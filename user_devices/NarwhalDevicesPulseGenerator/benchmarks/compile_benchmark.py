@@ -0,0 +1,171 @@
+'''
+Benchmarks NarwhalDevicesPulseGenerator.pseudo_inst_to_ndpg_inst on a large synthetic shot, and checks that it produces
+exactly the same PULSE_PROGRAM as the original instruction-by-instruction implementation (kept below for reference).
+
+Run from the userlib directory (no hardware is needed):
+    python -m user_devices.NarwhalDevicesPulseGenerator.benchmarks.compile_benchmark
+'''
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from labscript import (
+    start,
+    stop,
+    wait,
+    labscript_init,
+    labscript_cleanup,
+    compiler,
+    DigitalOut,
+    AnalogOut,
+    ClockLine,
+    IntermediateDevice,
+)
+from user_devices.NarwhalDevicesPulseGenerator.labscript_devices import NarwhalDevicesPulseGenerator
+
+
+class _BenchmarkClockedDevice(IntermediateDevice):
+    '''Stand in for a device (eg. an NI card) clocked by one of the NDPG clocklines. It doesn't write anything to the shot file.'''
+    allowed_children = [AnalogOut, DigitalOut]
+    clock_limit = 1E6
+    def generate_code(self, hdf5_file):
+        pass
+
+
+def build_synthetic_shot(n_pulses, n_direct_outputs=8, ramp_every=50, wait_every=500):
+    '''Compiles a synthetic experiment with n_pulses pulses spread over the direct outputs, with a ramp on a
+    device clocked by an NDPG clockline every ramp_every pulses, and a wait every wait_every pulses.
+    Returns the NDPG labscript device, which can be used to call the compilation methods again.'''
+    h5_path = os.path.join(tempfile.mkdtemp(), 'ndpg_benchmark.h5')
+    labscript_init(h5_path, labscript_file=__file__, new=True, overwrite=True)
+    pg = NarwhalDevicesPulseGenerator(name='benchmark_ndpg', serial_number=0)
+    outputs = [DigitalOut(f'benchmark_do{i}', pg.direct_outputs, f'channel {i}') for i in range(n_direct_outputs)]
+    clock_line = ClockLine('benchmark_clock_line', pg.pseudoclock, 'channel 23')
+    clocked_device = _BenchmarkClockedDevice('benchmark_clocked_device', clock_line)
+    analog_out = AnalogOut('benchmark_ao', clocked_device, 'ao0')
+
+    t = 0
+    start()
+    for k in range(n_pulses):
+        output = outputs[k % n_direct_outputs]
+        output.go_high(t)
+        t += 1E-6
+        output.go_low(t)
+        t += 1E-6
+        if ramp_every and k % ramp_every == ramp_every - 1:
+            analog_out.ramp(t, 200E-6, 0, 1, 1E5)
+            t += 300E-6
+        if wait_every and k % wait_every == wait_every - 1:
+            t += wait(f'benchmark_wait_{k}', t, timeout=1)
+    stop(t + 1E-6)
+    return pg
+
+
+def legacy_pseudo_inst_to_ndpg_inst(device):
+    '''The original implementation of NarwhalDevicesPulseGenerator.pseudo_inst_to_ndpg_inst, which builds a dict
+    for every device instruction. Only used to check the vectorised implementation gives the same table.'''
+    dig_outputs = device.direct_outputs.get_all_outputs()
+    wait_table = [compiler.wait_table[key] for key in sorted(compiler.wait_table)]
+    channel_state = np.ones(24, dtype=np.int64)*-1
+    raw_output_idx = -1
+    address = 0
+    ndpg_inst = []
+    ACsync = False
+    next_instruction_notify = False
+    wait_idx = 0
+
+    def new_inst(duration, stop_and_wait=False, notify_computer=False, powerline_sync=False, goto_address=0, goto_counter=0):
+        return {'address':address, 'duration':duration, 'channel_state':channel_state.copy(), 'goto_address':goto_address,
+                'goto_counter':goto_counter, 'stop_and_wait':stop_and_wait, 'hardware_trig_out':False,
+                'notify_computer':notify_computer, 'powerline_sync':powerline_sync}
+
+    for instruction in device.pseudoclock.clock:
+        if instruction == 'WAIT':
+            ACsync = wait_table[wait_idx][0].startswith('ACsync')
+            wait_idx += 1
+            if len(ndpg_inst) == 0:
+                ndpg_inst.append(new_inst(1, stop_and_wait=True, notify_computer=True))
+                address += 1
+                if ACsync:
+                    ndpg_inst.append(new_inst(1, notify_computer=True, powerline_sync=True))
+                    address += 1
+                else:
+                    next_instruction_notify = True
+                ACsync = False
+            else:
+                ndpg_inst[-1]['stop_and_wait'] = True
+                ndpg_inst[-1]['notify_computer'] = True
+                next_instruction_notify = True
+            continue
+
+        only_internal = True
+        for clock_line in instruction['enabled_clocks']:
+            if clock_line == device._direct_output_clock_line:
+                raw_output_idx += 1
+            else:
+                channel_state[int(clock_line.connection.split()[1])] = 1
+                only_internal = False
+        for output in dig_outputs:
+            channel_state[int(output.connection.split()[1])] = output.raw_output[raw_output_idx]
+
+        if only_internal:
+            duration = int(np.round((instruction['step']/device.clock_resolution)))
+            ndpg_inst.append(new_inst(duration, notify_computer=next_instruction_notify, powerline_sync=ACsync))
+            address += 1
+        else:
+            high_time = instruction['step']/2
+            low_time = instruction['step'] - high_time
+            duration = int(np.round((high_time/device.clock_resolution)))
+            ndpg_inst.append(new_inst(duration, notify_computer=next_instruction_notify, powerline_sync=ACsync))
+            loop_start_address = address
+            address += 1
+            for clock_line in instruction['enabled_clocks']:
+                if clock_line != device._direct_output_clock_line:
+                    channel_state[int(clock_line.connection.split()[1])] = 0
+            goto_counter = 0 if instruction['reps'] == 0 else instruction['reps'] - 1
+            duration = int(np.round((low_time/device.clock_resolution)))
+            ndpg_inst.append(new_inst(duration, goto_address=loop_start_address, goto_counter=goto_counter))
+            address += 1
+        ACsync = False
+        next_instruction_notify = False
+
+    # Pack the channel states into the PULSE_PROGRAM format, where -1 means the channel is unspecified
+    inst_table = np.empty(len(ndpg_inst), dtype=device.pulse_program_dtype)
+    for field in ['address', 'duration', 'goto_address', 'goto_counter', 'stop_and_wait', 'hardware_trig_out', 'notify_computer', 'powerline_sync']:
+        inst_table[field] = [inst[field] for inst in ndpg_inst]
+    channel_states = np.array([inst['channel_state'] for inst in ndpg_inst]).reshape(len(ndpg_inst), 24)
+    channel_bits = 1 << np.arange(24, dtype=np.uint32)
+    inst_table['state'] = ((channel_states == 1)*channel_bits).sum(axis=1)
+    inst_table['state_specified'] = ((channel_states != -1)*channel_bits).sum(axis=1)
+    return inst_table
+
+
+def best_time(function, repeats):
+    times = []
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        result = function()
+        times.append(time.perf_counter() - t0)
+    return min(times), result
+
+
+def main(n_pulses=20000, repeats=5):
+    pg = build_synthetic_shot(n_pulses)
+    legacy_time, legacy_table = best_time(lambda: legacy_pseudo_inst_to_ndpg_inst(pg), repeats)
+    vectorised_time, vectorised_table = best_time(pg.pseudo_inst_to_ndpg_inst, repeats)
+    labscript_cleanup()
+
+    assert legacy_table.dtype == vectorised_table.dtype
+    for field in legacy_table.dtype.names:
+        assert np.array_equal(legacy_table[field], vectorised_table[field]), f'PULSE_PROGRAM column {field} differs'
+
+    print(f'{len(pg.pseudoclock.clock)} pseudoclock instructions -> {len(vectorised_table)} NDPG instructions')
+    print(f'legacy:     {legacy_time*1E3:.2f} ms')
+    print(f'vectorised: {vectorised_time*1E3:.2f} ms ({legacy_time/vectorised_time:.1f}x faster)')
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
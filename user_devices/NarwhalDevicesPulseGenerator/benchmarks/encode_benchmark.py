@@ -0,0 +1,38 @@
+'''
+Benchmarks transcode.encode_instructions against ndpulsegen.encode_instruction (called once per instruction, as the BLACS
+worker used to). That the two produce exactly the same bytes is checked by test_transcode.
+
+Run from the userlib directory (no hardware is needed):
+    python -m user_devices.NarwhalDevicesPulseGenerator.benchmarks.encode_benchmark
+'''
+import sys
+import time
+
+import numpy as np
+
+from user_devices.NarwhalDevicesPulseGenerator.transcode import encode_instructions
+from user_devices.NarwhalDevicesPulseGenerator.test_transcode import random_pulse_program, reference_encode
+
+
+def best_time(function, repeats):
+    times = []
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        result = function()
+        times.append(time.perf_counter() - t0)
+    return min(times), result
+
+
+def main(n_instructions=8192, repeats=5):
+    pulse_program = random_pulse_program(np.random.default_rng(1), n_instructions)
+    reference_time, reference_bytes = best_time(lambda: reference_encode(pulse_program), repeats)
+    vectorised_time, vectorised_bytes = best_time(lambda: encode_instructions(pulse_program).tobytes(), repeats)
+    assert reference_bytes == vectorised_bytes
+
+    print(f'{n_instructions} instructions -> {len(vectorised_bytes)} bytes')
+    print(f'per instruction: {reference_time*1E3:.2f} ms')
+    print(f'vectorised:      {vectorised_time*1E3:.2f} ms ({reference_time/vectorised_time:.1f}x faster)')
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
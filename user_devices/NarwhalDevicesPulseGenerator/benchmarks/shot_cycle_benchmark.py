@@ -0,0 +1,292 @@
+'''
+End-to-end benchmark of the NDPG shot cycle, from compiling the shot to BLACS returning to manual mode. No hardware is
+needed: the BLACS worker runs in this process, on emulated Pulse Generators (see emulator.EmulatedPulseGenerator) with
+the bandwidth of the real serial link, and a typical USB latency.
+
+Synthetic experiments of increasing size (pulses on the direct outputs, waits, ramps on a device clocked by an NDPG
+clockline, and the number of NDPGs) are compiled, and for each one this times:
+    compile:    the whole labscript compilation, NarwhalDevicesPulseGenerator.pseudo_inst_to_ndpg_inst and
+                NarwhalDevicesPulseGenerator.write_ndpg_inst_to_h5
+    upload:     the parts of the worker's transition_to_buffered (reading the shot file, encoding the instructions, and
+                uploading them), and the whole of it, for a first shot and a repeat of the same shot (smart programming)
+    run:        from start_run until the run_finished event arrives, and how long that event takes after the emulated
+                device sends its finished notification (run completion detection)
+    manual:     transition_to_manual
+The results are written to a JSON file (with the git commit), so runs on different commits can be compared. It goes in
+the temporary directory unless a path is given, so a run doesn't leave files in the repository.
+
+Run from the userlib directory:
+    python -m user_devices.NarwhalDevicesPulseGenerator.benchmarks.shot_cycle_benchmark [results.json] [max_pulses]
+'''
+import contextlib
+import io
+import json
+import logging
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import labscript_utils.h5_lock, h5py
+import labscript_utils.properties
+import numpy as np
+import zprocess
+
+from labscript import (
+    start,
+    stop,
+    wait,
+    labscript_init,
+    labscript_cleanup,
+    DigitalOut,
+    AnalogOut,
+    ClockLine,
+    IntermediateDevice,
+)
+from user_devices.NarwhalDevicesPulseGenerator.labscript_devices import NarwhalDevicesPulseGenerator
+from user_devices.NarwhalDevicesPulseGenerator.blacs_workers import NarwhalDevicesPulseGeneratorWorker
+from user_devices.NarwhalDevicesPulseGenerator.transcode import encode_instructions
+
+
+sizes = [
+    {'n_pulses': 1000, 'n_waits': 1, 'n_ramps': 10, 'n_ndpgs': 1},
+    {'n_pulses': 10000, 'n_waits': 5, 'n_ramps': 100, 'n_ndpgs': 1},
+    {'n_pulses': 10000, 'n_waits': 5, 'n_ramps': 100, 'n_ndpgs': 2},
+    {'n_pulses': 100000, 'n_waits': 20, 'n_ramps': 1000, 'n_ndpgs': 2},
+    {'n_pulses': 100000, 'n_waits': 20, 'n_ramps': 500, 'n_ndpgs': 4},
+]
+'''The synthetic experiments, smallest first.'''
+
+serial_latency = 1E-3
+'''Latency of the emulated serial link (seconds), about that of a USB serial adapter.'''
+
+wait_timeout = 10E-3
+'''Timeout of every wait. Nothing ends the waits of the master NDPG, so they all time out and are restarted by the worker.'''
+
+hardware_trigger_interval = 100E-6
+'''Secondary NDPGs are emulated with a hardware trigger this often (seconds), which starts them and ends their waits.'''
+
+repeats = 3
+'''The stages that don't change anything are repeated, and the best time is kept.'''
+
+
+class _BenchmarkClockedDevice(IntermediateDevice):
+    '''Stand in for a device (eg. an NI card) clocked by one of the NDPG clocklines. It doesn't write anything to the shot file.'''
+    allowed_children = [AnalogOut, DigitalOut]
+    clock_limit = 1E6
+    def generate_code(self, hdf5_file):
+        pass
+
+
+def build_synthetic_shot(h5_path, n_pulses, n_waits, n_ramps, n_ndpgs, n_direct_outputs=8):
+    '''Compiles a synthetic experiment to h5_path: n_pulses pulses spread over the direct outputs of every NDPG, with
+    n_ramps ramps on a device clocked by a clockline of the master NDPG and n_waits waits spread evenly through it.
+    NDPG k>0 is a secondary pseudoclock, triggered by channel 23-k of the master (labscript
+    doesn't allow secondaries to trigger each other). Returns the NDPG labscript devices (master first).'''
+    labscript_init(h5_path, labscript_file=__file__, new=True, overwrite=True)
+    ndpgs = [NarwhalDevicesPulseGenerator(name='benchmark_ndpg0', serial_number=0)]
+    for k in range(1, n_ndpgs):
+        ndpgs.append(NarwhalDevicesPulseGenerator(name=f'benchmark_ndpg{k}', serial_number=k, trigger_device=ndpgs[0].direct_outputs, trigger_connection=f'channel {23 - k}'))
+    outputs = [DigitalOut(f'benchmark_ndpg{k}_do{i}', ndpg.direct_outputs, f'channel {i}') for k, ndpg in enumerate(ndpgs) for i in range(n_direct_outputs)]
+    clock_line = ClockLine('benchmark_clock_line', ndpgs[0].pseudoclock, 'channel 23')
+    clocked_device = _BenchmarkClockedDevice('benchmark_clocked_device', clock_line)
+    analog_out = AnalogOut('benchmark_ao', clocked_device, 'ao0')
+
+    ramp_every = n_pulses//n_ramps if n_ramps else 0
+    wait_every = n_pulses//(n_waits + 1) if n_waits else 0
+    t = 0
+    start()
+    for k in range(n_pulses):
+        output = outputs[k % len(outputs)]
+        output.go_high(t)
+        t += 1E-6
+        output.go_low(t)
+        t += 1E-6
+        if ramp_every and k % ramp_every == ramp_every - 1:
+            analog_out.ramp(t, 200E-6, 0, 1, 1E5)
+            t += 300E-6
+        if wait_every and k % wait_every == wait_every - 1 and k//wait_every < n_waits:
+            t += wait(f'benchmark_wait_{k}', t, timeout=wait_timeout)
+    stop(t + 1E-6)
+    return ndpgs
+
+
+def best_time(function, repeats=repeats):
+    times = []
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        result = function()
+        times.append(time.perf_counter() - t0)
+    return min(times), result
+
+
+def make_worker(device_name, serial_number, emulator_options):
+    '''A worker running in this process, set up as BLACS would (see NarwhalDevicesPulseGeneratorTab.initialise_workers),
+    but connected to an emulated Pulse Generator.'''
+    worker = NarwhalDevicesPulseGeneratorWorker.__new__(NarwhalDevicesPulseGeneratorWorker)
+    worker.device_name = device_name
+    # Worker.run sets this up in BLACS
+    worker.logger = logging.getLogger(f'BLACS.{device_name}.worker')
+    worker.serial_number = serial_number
+    worker.num_DO = 24
+    worker.connection_table_properties = {'emulate': True, 'emulator_options': emulator_options}
+    worker.init()
+    return worker
+
+
+def time_compile_stages(ndpg, h5_path):
+    '''Times pseudo_inst_to_ndpg_inst, and write_ndpg_inst_to_h5 for the PULSE_PROGRAM that was compiled into h5_path.'''
+    pseudo_inst_time, ndpg_inst = best_time(ndpg.pseudo_inst_to_ndpg_inst)
+    with h5py.File(h5_path, 'r') as hdf5_file:
+        pulse_program = hdf5_file[f'devices/{ndpg.name}/PULSE_PROGRAM'][:]
+    scratch_path = os.path.join(os.path.dirname(h5_path), 'write_benchmark.h5')
+    write_times = []
+    for _ in range(repeats):
+        with h5py.File(scratch_path, 'w') as hdf5_file:
+            hdf5_file.create_group(f'devices/{ndpg.name}')
+            # stop_time was already set when the shot was compiled, and labscript only allows a property to be set once
+            ndpg._properties['device_properties'].pop('stop_time', None)
+            t0 = time.perf_counter()
+            ndpg.write_ndpg_inst_to_h5(pulse_program, hdf5_file)
+            write_times.append(time.perf_counter() - t0)
+    os.remove(scratch_path)
+    return {'pseudo_inst_to_ndpg_inst': pseudo_inst_time, 'write_ndpg_inst_to_h5': min(write_times),
+            'n_device_instructions': len(ndpg_inst), 'n_instructions': len(pulse_program)}
+
+
+def time_upload_stages(worker, h5_path):
+    '''Times the parts of transition_to_buffered separately: reading the shot file, encoding the instructions, and
+    uploading them (all of them, as for a fresh shot).'''
+    def read():
+        with h5py.File(h5_path, 'r') as hdf5_file:
+            # Kept on the worker as transition_to_buffered does, since write_instructions_smart needs max_instructions
+            worker.device_properties = labscript_utils.properties.get(hdf5_file, worker.device_name, 'device_properties')
+            group = hdf5_file[f'devices/{worker.device_name}']
+            return group['PULSE_PROGRAM'][:], group['PULSE_PROGRAM_ENCODED'][:], group['WAIT_ADDRESSES'][:]
+    read_time, (pulse_program, encoded, wait_addresses) = best_time(read)
+    encode_time, instructions = best_time(lambda: encode_instructions(pulse_program))
+    t0 = time.perf_counter()
+    worker.write_instructions_smart(pulse_program['address'], instructions, fresh=True)
+    upload_time = time.perf_counter() - t0
+    return {'h5_read': read_time, 'encode': encode_time, 'upload': upload_time, 'upload_bytes': instructions.size}
+
+
+def run_shot(workers, h5_path, fresh):
+    '''One shot cycle, as BLACS would run it: transition_to_buffered on every device, start the master, wait for every
+    device to say it has finished, and transition_to_manual.'''
+    initial_values = {f'channel {channel}': False for channel in range(24)}
+    run_finished = {name: zprocess.Event(f'{name}_run_finished', type='wait') for name in workers}
+    timings = {name: {} for name in workers}
+    # Secondaries first, so they are armed before the master starts
+    for name, worker in reversed(list(workers.items())):
+        t0 = time.perf_counter()
+        worker.transition_to_buffered(name, h5_path, initial_values, fresh)
+        timings[name]['transition_to_buffered'] = time.perf_counter() - t0
+
+    # Every device is waited for in its own thread, so each one's run_finished event is timed as it arrives
+    received = {}
+    def wait_for_run_finished(name):
+        run_finished[name].wait(h5_path, timeout=60)
+        received[name] = (time.perf_counter(), time.time())
+    waiters = [threading.Thread(target=wait_for_run_finished, args=(name,)) for name in workers]
+    for waiter in waiters:
+        waiter.start()
+    master = next(iter(workers.values()))
+    start_time = time.perf_counter()
+    master.start_run()
+    for waiter in waiters:
+        waiter.join()
+
+    for name, worker in workers.items():
+        # Secondaries are started by their emulated hardware trigger as soon as they are armed, not by the master, so
+        # their run can be (close to) finished before the master starts and is only an upper bound on its length
+        timings[name]['run'] = received[name][0] - start_time
+        # The finished notification is kept with the important ones, with the time the emulated device sent it. The
+        # worker posts run_finished before it records the notification, so it might take a moment to show up.
+        finished = []
+        deadline = time.monotonic() + 1
+        while not finished and time.monotonic() < deadline:
+            finished = [event for event in worker.notification_buffer.read(0, 0)[0] if event['finished_notify']]
+        timings[name]['run_completion_detection'] = received[name][1] - finished[-1]['timestamp'] if finished else None
+
+    for name, worker in workers.items():
+        t0 = time.perf_counter()
+        success = worker.transition_to_manual()
+        timings[name]['transition_to_manual'] = time.perf_counter() - t0
+        if not success:
+            raise RuntimeError(f'{name} did not finish the shot')
+    return timings
+
+
+def benchmark(size, directory):
+    result = {'size': size}
+    h5_path = os.path.join(directory, 'shot_cycle_benchmark.h5')
+    with contextlib.redirect_stdout(io.StringIO()):
+        t0 = time.perf_counter()
+        ndpgs = build_synthetic_shot(h5_path, **size)
+        result['compile'] = time.perf_counter() - t0
+        devices = {ndpg.name: time_compile_stages(ndpg, h5_path) for ndpg in ndpgs}
+        labscript_cleanup()
+
+        workers = {}
+        for k, ndpg in enumerate(ndpgs):
+            emulator_options = {'speed': None, 'baudrate': NarwhalDevicesPulseGenerator.serial_baudrate, 'latency': serial_latency}
+            if k > 0:
+                emulator_options['hardware_trigger_interval'] = hardware_trigger_interval
+            workers[ndpg.name] = make_worker(ndpg.name, k, emulator_options)
+        try:
+            for name, worker in workers.items():
+                devices[name].update(time_upload_stages(worker, h5_path))
+            # Each shot file can only be run once, so run copies of it. The second is the same shot again, so
+            # smart programming has nothing to upload.
+            for shot in ['first_shot', 'repeat_shot']:
+                shot_path = os.path.join(directory, f'{shot}.h5')
+                shutil.copy(h5_path, shot_path)
+                for name, timings in run_shot(workers, shot_path, fresh=(shot == 'first_shot')).items():
+                    devices[name][shot] = timings
+        finally:
+            for worker in workers.values():
+                worker.shutdown()
+                worker.pg.disconnect()
+    result['devices'] = devices
+    return result
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(output_path=None, max_pulses=None):
+    if output_path is None:
+        output_path = os.path.join(tempfile.gettempdir(), 'shot_cycle_benchmark.json')
+    results = {'git_commit': git_commit(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(),
+               'numpy': np.__version__, 'platform': platform.platform(), 'serial_baudrate': NarwhalDevicesPulseGenerator.serial_baudrate,
+               'serial_latency': serial_latency, 'wait_timeout': wait_timeout, 'results': []}
+    directory = tempfile.mkdtemp()
+    try:
+        for size in sizes:
+            if max_pulses is not None and size['n_pulses'] > max_pulses:
+                continue
+            result = benchmark(size, directory)
+            results['results'].append(result)
+            master = next(iter(result['devices'].values()))
+            print(f"{size}: compile {result['compile']:.3f} s, {master['n_instructions']} instructions, " +
+                  f"first shot transition_to_buffered {master['first_shot']['transition_to_buffered']*1E3:.1f} ms, " +
+                  f"run {master['first_shot']['run']*1E3:.1f} ms, transition_to_manual {master['first_shot']['transition_to_manual']*1E3:.1f} ms")
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    with open(output_path, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f'Results written to {output_path}')
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:2], *[int(arg) for arg in sys.argv[2:3]])
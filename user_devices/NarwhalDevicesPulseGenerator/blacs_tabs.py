@@ -4,15 +4,20 @@ I'm not sure how I am supposed to import other classes from files within this de
 # from .blacs_workers import NarwhalDevicesPulseGeneratorWorker
 
 import os
+import threading
+import time
+from collections import deque
 from datetime import datetime
 
+import zprocess
+
 from blacs.device_base_class import DeviceTab, define_state, MODE_BUFFERED
 from blacs.tab_base_classes import MODE_MANUAL, MODE_TRANSITION_TO_BUFFERED, MODE_TRANSITION_TO_MANUAL, MODE_BUFFERED  
 
 from qtutils import UiLoader
 from qtutils.qt import QtCore
 from qtutils.qt import QtGui
-from qtutils.qt.QtWidgets import QDoubleSpinBox, QComboBox, QTextEdit, QLabel
+from qtutils.qt.QtWidgets import QDoubleSpinBox, QComboBox, QLabel, QListView, QWidget, QVBoxLayout
 
 class CustomDoubleSpinBox(QDoubleSpinBox):
     editingFinished = QtCore.pyqtSignal()
@@ -45,33 +50,86 @@ class CustomComboBox(QComboBox):
         else:
             event.ignore()
 
-class CustomTextEdit(QTextEdit):
-    def __init__(self, max_lines=10, *args, **kwargs):
+class NotificationLogModel(QtCore.QAbstractListModel):
+    '''The lines of the notification log, in a ring buffer that holds the most recent max_lines. Each line is a 
+    (message_type, text) pair. The message type is returned for the MESSAGE_TYPE_ROLE, so the log can be filtered by it.'''
+    MESSAGE_TYPE_ROLE = QtCore.Qt.UserRole
+    def __init__(self, max_lines, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.max_lines = max_lines
-        self.current_lines = 0
-    def append(self, text):
-        super().append(text)
-        self.current_lines += 1
-        if self.current_lines > self.max_lines:
-            self.remove_oldest_line()
-    def remove_oldest_line(self):
-        cursor = self.textCursor()
-        cursor.movePosition(QtGui.QTextCursor.Start)
-        cursor.movePosition(QtGui.QTextCursor.EndOfBlock, QtGui.QTextCursor.KeepAnchor)
-        cursor.removeSelectedText()
-        cursor.deleteChar()
-        self.current_lines -= 1
+        self.lines = deque(maxlen=max_lines)
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        return 0 if parent.isValid() else len(self.lines)
+    def data(self, index, role=QtCore.Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        if role == QtCore.Qt.DisplayRole:
+            return self.lines[index.row()][1]
+        if role == self.MESSAGE_TYPE_ROLE:
+            return self.lines[index.row()][0]
+        return None
+    def append_lines(self, lines):
+        # All the lines are added at once, so the view only updates once, however many there are
+        lines = list(lines)[-self.lines.maxlen:]
+        if not lines:
+            return
+        n_removed = max(0, len(self.lines) + len(lines) - self.lines.maxlen)
+        if n_removed:
+            self.beginRemoveRows(QtCore.QModelIndex(), 0, n_removed - 1)
+            for _ in range(n_removed):
+                self.lines.popleft()
+            self.endRemoveRows()
+        self.beginInsertRows(QtCore.QModelIndex(), len(self.lines), len(self.lines) + len(lines) - 1)
+        self.lines.extend(lines)
+        self.endInsertRows()
+
+class CustomListView(QListView):
     def wheelEvent(self, event):
         if self.hasFocus():
             super().wheelEvent(event)
         else:
             event.ignore()
 
+class NotificationLogWidget(QWidget):
+    '''Read only log of notifications and errors, with a combo box to only show one type of message.'''
+    message_types = {'All messages': '', 'Notifications': 'notification', 'Summaries': 'summary', 'Errors': 'error'}
+    def __init__(self, max_lines=10, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.model = NotificationLogModel(max_lines, self)
+        self.filter_model = QtCore.QSortFilterProxyModel(self)
+        self.filter_model.setSourceModel(self.model)
+        self.filter_model.setFilterRole(NotificationLogModel.MESSAGE_TYPE_ROLE)
+        self.combo_message_type = CustomComboBox(focusPolicy=QtCore.Qt.StrongFocus)
+        self.combo_message_type.addItems(list(self.message_types))
+        self.combo_message_type.currentTextChanged.connect(self.message_type_textchanged)
+        self.view = CustomListView(focusPolicy=QtCore.Qt.StrongFocus)
+        self.view.setModel(self.filter_model)
+        self.view.setUniformItemSizes(True)     # So the view doesn't have to measure every line
+        self.view.setEditTriggers(QListView.NoEditTriggers)
+        self.view.setSelectionMode(QListView.ExtendedSelection)
+        layout = QVBoxLayout(self)
+        layout.setContentsMargins(0, 0, 0, 0)
+        layout.addWidget(self.combo_message_type)
+        layout.addWidget(self.view)
+    def message_type_textchanged(self, message_type):
+        self.filter_model.setFilterFixedString(self.message_types[message_type])
+    def append_lines(self, lines):
+        # Keep following the end of the log, unless the user has scrolled up to look at something
+        scrollbar = self.view.verticalScrollBar()
+        at_bottom = scrollbar.value() == scrollbar.maximum()
+        self.model.append_lines(lines)
+        if at_bottom:
+            self.view.scrollToBottom()
+
 class NarwhalDevicesPulseGeneratorTab(DeviceTab):
     # See phil's thesis p148
     # Capabilities
     num_DO = 24
+
+    gui_refresh_interval = 0.9 # seconds
+    '''The status widgets are refreshed at most this often when status_monitor is called by a timer (notifications, and 
+    the end of the run, are still handled on every call). A little less than the 1s timer used in manual mode, so that 
+    every call in manual mode refreshes them, but only every other call does during a run.'''
+
     def __init__(self,*args,**kwargs):
         DeviceTab.__init__(self,*args,**kwargs)
         # This will be assigned the queue which is passed to the start_run method.
@@ -81,6 +139,11 @@ class NarwhalDevicesPulseGeneratorTab(DeviceTab):
         # if a "finished notification" was recieved on one of these calls, status_monitor would
         # not have access to the notify_queue to tell labscript it is done.
         self.notify_queue = None
+        # Both the status_monitor and the wait_for_run_finished thread can find out that the run is finished
+        self.notify_queue_lock = threading.Lock()
+        # What the status widgets currently display, keyed by name, so only widgets whose values have changed are updated.
+        self.displayed_status = {}
+        self.last_gui_refresh = -float('inf')
 
     def initialise_workers(self):
         """Initialises the  Workers.
@@ -143,8 +206,8 @@ class NarwhalDevicesPulseGeneratorTab(DeviceTab):
         # and auto place the widgets in the UI
         self.auto_place_widgets(("Channels",do_widgets,sort))
         
-        # Look into this after I have made it work in a more basic fashon. Also, it if fast to load instructions, so I'm not sure if this is necessary.
-        # self.supports_smart_programming(True) 
+        # The worker only uploads the instructions that have changed since the last shot, unless smart programming is cleared.
+        self.supports_smart_programming(True) 
         
         #Checks state on startup
         '''This is sort of causing some issues. This works as it should, but BLACS somehow remembers the state the NDPG was in when blacs last closed, and then there is a conflict and I have to choose which is correct.
@@ -195,13 +258,19 @@ class NarwhalDevicesPulseGeneratorTab(DeviceTab):
         # Notifications
         self.ui.check_notifytrigout.toggled.connect(self.notifytrigout_toggled)
         self.ui.check_notifyfinished.toggled.connect(self.notifyfinished_toggled)
-        self.ui.text_notifications = CustomTextEdit(max_lines=10000, focusPolicy=QtCore.Qt.StrongFocus)
-        self.ui.text_notifications.setReadOnly(True)
-        self.ui.verticalLayout_notifications.addWidget(self.ui.text_notifications)
+        self.ui.notification_log = NotificationLogWidget(max_lines=10000)
+        self.ui.verticalLayout_notifications.addWidget(self.ui.notification_log)
+
+        # The tick and cross shown by the status labels, made once rather than every time they change
+        self.status_pixmaps = {True: QtGui.QIcon(':/qtutils/fugue/tick').pixmap(QtCore.QSize(16, 16)),
+                               False: QtGui.QIcon(':/qtutils/fugue/cross').pixmap(QtCore.QSize(16, 16))}
 
         # Status monitor timout
         self.statemachine_timeout_add(1000, self.status_monitor)
 
+        # Posted by the worker the moment the Pulse Generator says the run has finished
+        self.run_finished_event = zprocess.Event(f'{self.device_name}_run_finished', type='wait')
+
         #Get the device hardware version, firmware version and serial numbers
         self.get_device_info()
 
@@ -243,8 +312,28 @@ class NarwhalDevicesPulseGeneratorTab(DeviceTab):
         timer, and it is up to the status_monitor to work out when the run is done"""
         self.notify_queue = notify_queue
         self.statemachine_timeout_remove(self.status_monitor)
-        yield(self.queue_work(self._primary_worker,'start_run'))
-        self.statemachine_timeout_add(100,self.status_monitor)
+        h5_file = yield(self.queue_work(self._primary_worker,'start_run'))
+        # Don't wait for the next status_monitor to find out the run has finished
+        threading.Thread(target=self.wait_for_run_finished, args=(h5_file, notify_queue), daemon=True).start()
+        self.statemachine_timeout_add(500,self.status_monitor)
+
+    def wait_for_run_finished(self, h5_file, notify_queue):
+        # Runs in its own thread until the run is finished, or the notify_queue is dropped (eg. the run was aborted)
+        while self.notify_queue is notify_queue:
+            try:
+                self.run_finished_event.wait(h5_file, timeout=1)
+            except zprocess.TimeoutError:
+                continue
+            self.run_finished(notify_queue)
+            break
+
+    def run_finished(self, notify_queue=None):
+        # Tell BLACS the run is done. Only the first caller for each run actually does anything.
+        with self.notify_queue_lock:
+            if self.notify_queue is None or (notify_queue is not None and self.notify_queue is not notify_queue):
+                return
+            notify_queue, self.notify_queue = self.notify_queue, None
+        notify_queue.put('done')
 
     #These call methods of the blacs_worker, which send signals to the device. Need to decide what to have. start_run is compulsury, the others I can choose what I like.
     ###################### Methods dealing with BLACS_tab GUI ###################################
@@ -256,8 +345,38 @@ class NarwhalDevicesPulseGeneratorTab(DeviceTab):
         self.ui.label_hardwareversion.setText(f"{device_info['hardware_version']}")
         self.ui.label_comport.setText(f"{device_info['comport']}") 
 
+    def status_changed(self, name, value):
+        '''Returns True if value is different to what the GUI last displayed for name, and remembers it as displayed.'''
+        if name in self.displayed_status and self.displayed_status[name] == value:
+            return False
+        self.displayed_status[name] = value
+        return True
+
+    @define_state(MODE_MANUAL,True,delete_stale_states=True)
+    def forget_displayed_status(self):
+        '''Makes the next status_monitor refresh every status widget. Queued after anything else that sets the output
+        widgets (eg. restoring the front panel values), since the widgets may then no longer show what was last polled.'''
+        self.displayed_status = {}
+
+    # These are states of DeviceTab. Calling them only queues them, so forget_displayed_status is queued to run after them.
+    def program_device(self):
+        DeviceTab.program_device(self)
+        self.forget_displayed_status()
+
+    def transition_to_manual(self, notify_queue, program=False):
+        DeviceTab.transition_to_manual(self, notify_queue, program)
+        self.forget_displayed_status()
+
+    def abort_buffered(self, notify_queue):
+        DeviceTab.abort_buffered(self, notify_queue)
+        self.forget_displayed_status()
+
+    def abort_transition_to_buffered(self, workers=None):
+        DeviceTab.abort_transition_to_buffered(self, workers)
+        self.forget_displayed_status()
+
     @define_state(MODE_MANUAL|MODE_BUFFERED|MODE_TRANSITION_TO_BUFFERED|MODE_TRANSITION_TO_MANUAL,True)  
-    def status_monitor(self):
+    def status_monitor(self, force_gui_refresh=False):
         """Gets the status of the Pulse Generator from the worker.
         This is called by in three ways:
             By a timer set up when GUI is initialised, with a fairly infrequent call.
@@ -269,49 +388,51 @@ class NarwhalDevicesPulseGeneratorTab(DeviceTab):
             BUT ALSO to figure out when the run is done, and when it is, to put 'done.' in the queue.
                 This indicates the end of an experimental run.
         Args:
-            notify_queue (:class:`~queue.Queue`): Queue to notify when
-                the experiment is done.
+            force_gui_refresh (bool): Refresh every status widget now, rather than only the ones 
+                that have changed, at most every gui_refresh_interval.
 
         """  
-        state, powerline_state, state_extras, notifications, pg_comms_in_errors, bytesdropped_error, status_check_timer, run_aborted = yield(self.queue_work(self._primary_worker,'check_status'))
+        # The status widgets are only refreshed every so often, but notifications are always handled, so the end of the run is never missed
+        if force_gui_refresh:
+            self.displayed_status = {}
+        refresh_gui = force_gui_refresh or time.monotonic() - self.last_gui_refresh >= self.gui_refresh_interval
+        state, powerline_state, state_extras, notifications, notification_summary, pg_comms_in_errors, bytesdropped_error, status_check_timer, run_aborted = yield(self.queue_work(self._primary_worker,'check_status', refresh_gui))
 
         if state is not None and powerline_state is not None and state_extras is not None:
-            # Update UI widgets
+            self.last_gui_refresh = time.monotonic()
+            # Update UI widgets. Only the ones that have changed since they were last updated, since this is done often, for every Pulse Generator.
 
             # Digital values (not sure if this is how I am supposed to update them)
             for channel, channel_state in enumerate(state['state']):
-                self._DO[f'channel {channel}'].set_value(channel_state,program=False)
+                if self.status_changed(f'channel {channel}', channel_state):
+                    self._DO[f'channel {channel}'].set_value(channel_state,program=False)
 
             # Synchronisation
             if powerline_state['powerline_locked']:
                 powerline_freq = 1/(powerline_state['powerline_period']*10E-9)
             else:
                 powerline_freq = 0.0
-            self.ui.label_powerlinefrequency.setText(f'{powerline_freq:.3f} Hz')
-            self.ui.label_referenceclock.setText(f"{state['clock_source']}")
+            if self.status_changed('powerline_frequency', powerline_freq):
+                self.ui.label_powerlinefrequency.setText(f'{powerline_freq:.3f} Hz')
+            if self.status_changed('clock_source', state['clock_source']):
+                self.ui.label_referenceclock.setText(f"{state['clock_source']}")
             # Status
-            self.ui.label_currentaddress.setText(f"{state['current_address']}")
-            self.ui.label_finaladdress.setText(f"{state['final_address']}")
-            run_time_seconds = state_extras['run_time']*10E-9
-            self.ui.label_totalruntime.setText(f"{int(run_time_seconds//60)}min {run_time_seconds%60:.3f}sec")
-            tick_pixmap = QtGui.QIcon(':/qtutils/fugue/tick').pixmap(QtCore.QSize(16, 16))
-            cross_pixmap = QtGui.QIcon(':/qtutils/fugue/cross').pixmap(QtCore.QSize(16, 16))
-            if state['running']:
-                self.ui.label_running.setPixmap(tick_pixmap)
-            else:
-                self.ui.label_running.setPixmap(cross_pixmap)
-            if state['software_run_enable']:
-                self.ui.label_enablesoftware.setPixmap(tick_pixmap)
-            else:
-                self.ui.label_enablesoftware.setPixmap(cross_pixmap)
-            if state['hardware_run_enable']:
-                self.ui.label_enablehardware.setPixmap(tick_pixmap)
-            else:
-                self.ui.label_enablehardware.setPixmap(cross_pixmap)
-
-            self.ui.button_pause.blockSignals(True)
-            self.ui.button_pause.setChecked(not state['software_run_enable'])
-            self.ui.button_pause.blockSignals(False)
+            if self.status_changed('current_address', state['current_address']):
+                self.ui.label_currentaddress.setText(f"{state['current_address']}")
+            if self.status_changed('final_address', state['final_address']):
+                self.ui.label_finaladdress.setText(f"{state['final_address']}")
+            if self.status_changed('run_time', state_extras['run_time']):
+                run_time_seconds = state_extras['run_time']*10E-9
+                self.ui.label_totalruntime.setText(f"{int(run_time_seconds//60)}min {run_time_seconds%60:.3f}sec")
+            if self.status_changed('running', bool(state['running'])):
+                self.ui.label_running.setPixmap(self.status_pixmaps[bool(state['running'])])
+            if self.status_changed('software_run_enable', bool(state['software_run_enable'])):
+                self.ui.label_enablesoftware.setPixmap(self.status_pixmaps[bool(state['software_run_enable'])])
+                self.ui.button_pause.blockSignals(True)
+                self.ui.button_pause.setChecked(not state['software_run_enable'])
+                self.ui.button_pause.blockSignals(False)
+            if self.status_changed('hardware_run_enable', bool(state['hardware_run_enable'])):
+                self.ui.label_enablehardware.setPixmap(self.status_pixmaps[bool(state['hardware_run_enable'])])
 
             # Why block signals? Because other parts of labscript can update the Pulse Generator
             # internal settings, without going through the GUI. When the status_monitor then updates
@@ -320,71 +441,75 @@ class NarwhalDevicesPulseGeneratorTab(DeviceTab):
             # update the setting again, which is unnecessary and therefor wasetful.
 
             # Run mode
-            self.ui.combo_runmode.blockSignals(True)  
-            self.ui.combo_runmode.setCurrentText(state['run_mode'])
-            self.ui.combo_runmode.blockSignals(False)
+            if self.status_changed('run_mode', state['run_mode']):
+                self.ui.combo_runmode.blockSignals(True)  
+                self.ui.combo_runmode.setCurrentText(state['run_mode'])
+                self.ui.combo_runmode.blockSignals(False)
 
             # Trigger in
-            self.ui.combo_accept_hardware_trigger.blockSignals(True)  
-            self.ui.combo_accept_hardware_trigger.setCurrentText(state['accept_hardware_trigger'])
-            self.ui.combo_accept_hardware_trigger.blockSignals(False)
-
-            self.ui.check_waitforpowerline.blockSignals(True)
-            self.ui.check_waitforpowerline.setChecked(powerline_state['trig_on_powerline'])
-            self.ui.check_waitforpowerline.blockSignals(False)
-
-            if not self.ui.doublespin_powerlinedelay.user_editing: 
+            if self.status_changed('accept_hardware_trigger', state['accept_hardware_trigger']):
+                self.ui.combo_accept_hardware_trigger.blockSignals(True)  
+                self.ui.combo_accept_hardware_trigger.setCurrentText(state['accept_hardware_trigger'])
+                self.ui.combo_accept_hardware_trigger.blockSignals(False)
+
+            if self.status_changed('trig_on_powerline', powerline_state['trig_on_powerline']):
+                self.ui.check_waitforpowerline.blockSignals(True)
+                self.ui.check_waitforpowerline.setChecked(powerline_state['trig_on_powerline'])
+                self.ui.check_waitforpowerline.blockSignals(False)
+
+            # The spin boxes are left alone while the user is editing them. They are refreshed once editing is finished, which forces a refresh.
+            if not self.ui.doublespin_powerlinedelay.user_editing and self.status_changed('powerline_trigger_delay', (powerline_state['trig_on_powerline'], powerline_state['powerline_trigger_delay'])): 
                 self.ui.doublespin_powerlinedelay.setEnabled(powerline_state['trig_on_powerline'])
                 self.ui.doublespin_powerlinedelay.blockSignals(True)
                 self.ui.doublespin_powerlinedelay.setValue(powerline_state['powerline_trigger_delay']*10E-9*1E3)
                 self.ui.doublespin_powerlinedelay.blockSignals(False)
 
             # Trigger out
-            if not self.ui.doublespin_triggerduration.user_editing: 
+            if not self.ui.doublespin_triggerduration.user_editing and self.status_changed('trigger_out_length', state['trigger_out_length']): 
                 self.ui.doublespin_triggerduration.blockSignals(True)
                 self.ui.doublespin_triggerduration.setValue(state['trigger_out_length']*10E-9*1E6)
                 self.ui.doublespin_triggerduration.blockSignals(False)      
-            if not self.ui.doublespin_triggerdelay.user_editing: 
+            if not self.ui.doublespin_triggerdelay.user_editing and self.status_changed('trigger_out_delay', state['trigger_out_delay']): 
                 self.ui.doublespin_triggerdelay.blockSignals(True)
                 self.ui.doublespin_triggerdelay.setValue(state['trigger_out_delay']*10E-9)
                 self.ui.doublespin_triggerdelay.blockSignals(False)  
             # Notifications
-            self.ui.check_notifytrigout.blockSignals(True)
-            self.ui.check_notifytrigout.setChecked(state['notify_on_main_trig_out'])
-            self.ui.check_notifytrigout.blockSignals(False)
-            self.ui.check_notifyfinished.blockSignals(True)
-            self.ui.check_notifyfinished.setChecked(state['notify_on_run_finished'])
-            self.ui.check_notifyfinished.blockSignals(False)
-
-        # If the Pulse generator is sending lots of notifications, dont print them, and warn 
-        if len(notifications) < 1000:
-            print_notifications = True
-        else:
-            print_notifications = False
-
+            if self.status_changed('notify_on_main_trig_out', state['notify_on_main_trig_out']):
+                self.ui.check_notifytrigout.blockSignals(True)
+                self.ui.check_notifytrigout.setChecked(state['notify_on_main_trig_out'])
+                self.ui.check_notifytrigout.blockSignals(False)
+            if self.status_changed('notify_on_run_finished', state['notify_on_run_finished']):
+                self.ui.check_notifyfinished.blockSignals(True)
+                self.ui.check_notifyfinished.setChecked(state['notify_on_run_finished'])
+                self.ui.check_notifyfinished.blockSignals(False)
+
+        # If the Pulse generator is sending lots of notifications, the worker only sends the important ones, and a summary of the rest
+        # The log is updated once, with all the new lines
+        log_lines = []
         finished_notification_received = False
         for notification in notifications:
-            if print_notifications:
-                time_string = str(datetime.fromtimestamp(notification['timestamp'])).split()[1][:-3]
-                if notification['trigger_notify']:
-                    self.ui.text_notifications.append(time_string + ': Main trigger out activated.')
-                if notification['address_notify']:
-                    self.ui.text_notifications.append(time_string + f": Instruction {notification['address']} activated.")
-                if notification['finished_notify']:
-                    self.ui.text_notifications.append(time_string + ': Run finished.')
-                    finished_notification_received = True   
-            elif notification['finished_notify']:
+            time_string = str(datetime.fromtimestamp(notification['timestamp'])).split()[1][:-3]
+            if notification['trigger_notify']:
+                log_lines.append(('notification', time_string + ': Main trigger out activated.'))
+            if notification['address_notify']:
+                log_lines.append(('notification', time_string + f": Instruction {notification['address']} activated."))
+            if notification['finished_notify']:
+                log_lines.append(('notification', time_string + ': Run finished.'))
                 finished_notification_received = True   
 
+        if notification_summary is not None:
+            log_lines.append(('summary', f"{notification_summary['n_notifications']} notifications from {notification_summary['n_addresses']} instructions since the last update. Most frequent:"))
+            for address_summary in notification_summary['addresses']:
+                time_string = str(datetime.fromtimestamp(address_summary['timestamp'])).split()[1][:-3]
+                log_lines.append(('summary', f"    Instruction {address_summary['address']} activated {address_summary['count']} times, last at {time_string} (run time {address_summary['run_time']*10E-9:.8f} s)."))
+
         for comm_error in pg_comms_in_errors:
             time_string = str(datetime.fromtimestamp(comm_error['timestamp'])).split()[1][:-3]
-            self.ui.text_notifications.append(time_string + f": Error - Pulse Generator encountered a problem -> {str(comm_error)}")
+            log_lines.append(('error', time_string + f": Error - Pulse Generator encountered a problem -> {str(comm_error)}"))
         for dropped_error in bytesdropped_error:
             time_string = str(datetime.fromtimestamp(dropped_error['timestamp'])).split()[1][:-3]
-            self.ui.text_notifications.append(time_string + f": Error - The host recieved an invalid message from the Pulse Generator. {str(dropped_error)}")
-
-        if not print_notifications:
-            self.ui.text_notifications.append('Too many notifications. Not printing. Serial buffer is probably overflowing. Tab may crash soon.')
+            log_lines.append(('error', time_string + f": Error - The host recieved an invalid message from the Pulse Generator. {str(dropped_error)}"))
+        self.ui.notification_log.append_lines(log_lines)
 
         # Determine the done condition.
         # Possible corner cases:
@@ -410,66 +535,74 @@ class NarwhalDevicesPulseGeneratorTab(DeviceTab):
         if finished_notification_received:
             self.statemachine_timeout_remove(self.status_monitor)
             self.statemachine_timeout_add(1000,self.status_monitor)
-            if self.notify_queue is not None:
-                self.notify_queue.put('done')
-                self.notify_queue = None
+            # Usually wait_for_run_finished has already done this
+            self.run_finished()
 
 
     # I may need to somehow disable all of the buttons in and user entry widgets during the "transition_to_buffered" phase
     @define_state(MODE_MANUAL,True)  
     def start(self,widget=None):
         yield(self.queue_work(self._primary_worker,'start_run'))
-        self.status_monitor()
+        self.status_monitor(force_gui_refresh=True)
 
     @define_state(MODE_MANUAL,True) 
     def pause(self, checked, widget=None):
         enabled = not checked
         yield(self.queue_work(self._primary_worker,'set_run_enable_software', enabled))
-        self.status_monitor()
+        self.status_monitor(force_gui_refresh=True)
         
     @define_state(MODE_MANUAL,True)  
     def stop(self,widget=None):
         yield(self.queue_work(self._primary_worker,'set_disable_after_current_run'))
-        self.status_monitor()
+        self.status_monitor(force_gui_refresh=True)
         
     @define_state(MODE_MANUAL,True)  
     def reset(self,widget=None):
         yield(self.queue_work(self._primary_worker,'abort_buffered'))
         # At the moment, abort_buffered jsut sends a reset run anyway, but if I cange it in the future, I might have to make a separate function.
-        self.status_monitor()
+        self.status_monitor(force_gui_refresh=True)
 
     @define_state(MODE_MANUAL,True) 
     def runmode_textchanged(self, runmode, widget=None):
+        # The widget no longer shows what the device last reported, so make sure it is refreshed even if the device doesn't change
+        self.displayed_status.pop('run_mode', None)
         yield(self.queue_work(self._primary_worker,'set_runmode', runmode))
 
     @define_state(MODE_MANUAL,True) 
     def accept_hardware_trigger_textchanged(self, accept_hardware_trigger, widget=None):
+        self.displayed_status.pop('accept_hardware_trigger', None)
         yield(self.queue_work(self._primary_worker,'set_accept_hardware_trigger', accept_hardware_trigger))
 
     @define_state(MODE_MANUAL,True) 
     def waitforpowerline_toggled(self, checked, widget=None):
+        self.displayed_status.pop('trig_on_powerline', None)
         self.ui.doublespin_powerlinedelay.setEnabled(checked)
         yield(self.queue_work(self._primary_worker,'set_waitforpowerline', checked))
 
     @define_state(MODE_MANUAL,True) 
     def powerlinedelay_editingfinished(self, widget=None):
+        self.displayed_status.pop('powerline_trigger_delay', None)
         value = self.ui.doublespin_powerlinedelay.value()
         yield(self.queue_work(self._primary_worker,'set_powerlinedelay', int(value*1E-3/10E-9)))
 
     @define_state(MODE_MANUAL,True) 
     def triggerduration_editingfinished(self, widget=None):
+        self.displayed_status.pop('trigger_out_length', None)
         value = self.ui.doublespin_triggerduration.value()
         yield(self.queue_work(self._primary_worker,'set_triggerduration', int(value*1E-6/10E-9)))
 
     @define_state(MODE_MANUAL,True) 
     def triggerdelay_editingfinished(self, widget=None):
+        self.displayed_status.pop('trigger_out_delay', None)
         value = self.ui.doublespin_triggerdelay.value()
         yield(self.queue_work(self._primary_worker,'set_triggerdelay', int(value/10E-9)))
 
     @define_state(MODE_MANUAL,True) 
     def notifytrigout_toggled(self, checked, widget=None):
+        self.displayed_status.pop('notify_on_main_trig_out', None)
         yield(self.queue_work(self._primary_worker,'set_notifytrigout', checked))
 
     @define_state(MODE_MANUAL,True) 
     def notifyfinished_toggled(self, checked, widget=None):
+        self.displayed_status.pop('notify_on_run_finished', None)
         yield(self.queue_work(self._primary_worker,'set_notifyfinished', checked))
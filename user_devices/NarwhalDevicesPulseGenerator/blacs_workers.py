@@ -10,13 +10,121 @@ import queue
 import portalocker
 import tempfile
 import os
+import threading
+from collections import deque
+from .emulator import EmulatedPulseGenerator
+from .transcode import encode_instructions, instruction_message_dtype, find_wait_addresses, notification_dtype, notification_flags, pack_notification_flags, unpack_notifications
+
+
+class NotificationBuffer(object):
+    '''Holds the notifications received since the GUI last asked for them, in a fixed amount of memory no matter how many
+    arrive. Every notification goes into a preallocated ring buffer (so only the most recent ones are kept), and is also
+    counted against the address it came from. The notifications that matter (trigger out, run finished, waits) are kept
+    separately, so they are never lost to the ring buffer.'''
+
+    def __init__(self, size, n_addresses, max_events=1000):
+        self.lock = threading.Lock()
+        self.ring = np.zeros(size, dtype=notification_dtype)
+        self.n_written = 0      # Total number of notifications ever appended
+        self.n_read = 0         # n_written when the notifications were last read
+        # Per address aggregates since the notifications were last read
+        self.address_counts = np.zeros(n_addresses, dtype=np.int64)
+        self.address_timestamps = np.zeros(n_addresses, dtype=np.float64)
+        self.address_run_times = np.zeros(n_addresses, dtype=np.int64)
+        self.events = deque(maxlen=max_events)
+
+    def append(self, notification, important=False):
+        flags = pack_notification_flags(notification)
+        with self.lock:
+            self.ring[self.n_written % len(self.ring)] = (notification['timestamp'], notification['address'], flags, notification['run_time'])
+            self.n_written += 1
+            if notification['address_notify']:
+                address = notification['address']
+                self.address_counts[address] += 1
+                self.address_timestamps[address] = notification['timestamp']
+                self.address_run_times[address] = notification['run_time']
+            if important:
+                self.events.append(self.ring[(self.n_written - 1) % len(self.ring)].copy())
+
+    def read(self, max_notifications, max_addresses):
+        '''Returns (notifications, summary) for everything appended since the last read. If there are no more than
+        max_notifications, they are all returned (as dicts, in the order they arrived) and summary is None. Otherwise
+        only the important ones are returned, and the summary has the total number of notifications, and the count and
+        latest timestamp and run_time of the max_addresses most frequently notified addresses.'''
+        with self.lock:
+            n_new = self.n_written - self.n_read
+            if n_new <= max_notifications:
+                notifications = self.ring[np.arange(self.n_read, self.n_written) % len(self.ring)]
+                summary = None
+            else:
+                notifications = np.array(self.events, dtype=notification_dtype)
+                addresses = np.flatnonzero(self.address_counts)
+                # Most frequent first
+                addresses = addresses[np.argsort(self.address_counts[addresses], kind='stable')[::-1]]
+                summary = {'n_notifications': n_new, 'n_addresses': len(addresses),
+                           'addresses': [{'address': address, 'count': count, 'timestamp': timestamp, 'run_time': run_time}
+                                         for address, count, timestamp, run_time in zip(addresses[:max_addresses].tolist(),
+                                                                                        self.address_counts[addresses[:max_addresses]].tolist(),
+                                                                                        self.address_timestamps[addresses[:max_addresses]].tolist(),
+                                                                                        self.address_run_times[addresses[:max_addresses]].tolist())]}
+            self.address_counts[np.flatnonzero(self.address_counts)] = 0
+            self.events.clear()
+            self.n_read = self.n_written
+        return unpack_notifications(notifications), summary
+
+
+class NotificationLog(object):
+    '''Every notification received during a shot, for saving to the shot file. The notifications are stored in 
+    preallocated chunks of chunk_size, so recording one is cheap, and the chunks can be written one at a time.'''
+
+    def __init__(self, chunk_size):
+        self.chunk_size = chunk_size
+        self.chunks = [np.zeros(chunk_size, dtype=notification_dtype)]
+        self.n_in_last_chunk = 0
+
+    def append(self, notification):
+        if self.n_in_last_chunk == self.chunk_size:
+            self.chunks.append(np.zeros(self.chunk_size, dtype=notification_dtype))
+            self.n_in_last_chunk = 0
+        self.chunks[-1][self.n_in_last_chunk] = (notification['timestamp'], notification['address'], pack_notification_flags(notification), notification['run_time'])
+        self.n_in_last_chunk += 1
+
+    def __len__(self):
+        return (len(self.chunks) - 1)*self.chunk_size + self.n_in_last_chunk
+
+    def write(self, group, name):
+        '''Writes the log to a new dataset in the h5py group. The dataset is chunked the same way as the log, and 
+        written one chunk at a time, so the whole log is never copied into one big array.'''
+        dataset = group.create_dataset(name, shape=(0,), maxshape=(None,), chunks=(self.chunk_size,), dtype=notification_dtype)
+        for chunk_idx, chunk in enumerate(self.chunks):
+            n_rows = self.chunk_size if chunk_idx < len(self.chunks) - 1 else self.n_in_last_chunk
+            dataset.resize((len(dataset) + n_rows,))
+            dataset[-n_rows:] = chunk[:n_rows]
+        dataset.attrs['flags'] = ', '.join(f'bit {bit}: {name}' for name, bit in notification_flags)
+        dataset.attrs['run_time_units'] = '10ns clock cycles'
+        dataset.attrs['timestamp_units'] = 'host time recieved, seconds since the epoch'
+        return dataset
 
 
-#Temproary
-import inspect
-
 class NarwhalDevicesPulseGeneratorWorker(Worker):
     # See phil's thesis p151
+
+    snapshot_max_age = 0.2 #seconds
+    '''How old a cached state snapshot can be and still be used for refreshing the GUI, or checking remote values.'''
+
+    notification_buffer_size = 65536
+    '''How many of the most recent notifications are kept between calls to check_status (each takes 25 bytes).'''
+
+    gui_notification_limit = 100
+    '''If more notifications than this arrive between calls to check_status, the GUI is sent a summary of them instead.'''
+
+    gui_summary_addresses = 10
+    '''How many of the most frequently notified addresses are included in the summary.'''
+
+    notification_log_chunk_size = 4096
+    '''The chunk size of the notification log (recorded if the record_notifications device property is set), both in 
+    memory and in the shot file.'''
+
     def init(self):
         # Once off device initialisation code called when the
         # worker process is first started .
@@ -25,14 +133,19 @@ class NarwhalDevicesPulseGeneratorWorker(Worker):
         # manufacturer
         print('called blacs_workers.NarwhalDevicesPulseGeneratorWorker.init')
         # Connect to pulse generator and save device info
-        self.pg = ndpulsegen.PulseGenerator()
-
-        # ndpulsegen/comms.py hogs all the serial stuff when it is trying to connect. If two Pulse generators do this at the same time
-        # they can block eache other. This implements a lock so only one can attempt to connect at a time.
-        temp_dir = tempfile.gettempdir()
-        lock_file_path = os.path.join(temp_dir, 'NDPG_serial_connection.lock')
-        with portalocker.Lock(lock_file_path, timeout=10):
+        if self.connection_table_properties.get('emulate', False):
+            # No hardware. A software Pulse Generator with the same API (see emulator.py)
+            self.pg = EmulatedPulseGenerator(**(self.connection_table_properties.get('emulator_options', None) or {}))
             self.pg.connect(self.serial_number)
+        else:
+            self.pg = ndpulsegen.PulseGenerator()
+
+            # ndpulsegen/comms.py hogs all the serial stuff when it is trying to connect. If two Pulse generators do this at the same time
+            # they can block eache other. This implements a lock so only one can attempt to connect at a time.
+            temp_dir = tempfile.gettempdir()
+            lock_file_path = os.path.join(temp_dir, 'NDPG_serial_connection.lock')
+            with portalocker.Lock(lock_file_path, timeout=10):
+                self.pg.connect(self.serial_number)
 
 
         self.pg.write_echo(b'N')
@@ -54,65 +167,210 @@ class NarwhalDevicesPulseGeneratorWorker(Worker):
         self.h5_file = None
         self.started = False
         self.timeout_time = None
+        self.timeout_address = None
+
+        # What is currently in the instruction memory of the Pulse Generator, so that only instructions that change between shots are uploaded.
+        # Keyed by address: 'instructions' holds the encoded instruction last uploaded to each address, if 'uploaded' is True for that address.
+        # Nothing is known about the memory when we first connect, since the Pulse Generator may have been programmed by something else.
+        # 'program_id' identifies the whole program last uploaded (the pulse_program_hash of the shot, and the GUI values), if known.
+        self.smart_cache = {'instructions': None, 'uploaded': None, 'program_id': None}
+
+        # The last state reported by the Pulse Generator, which is reused by anything that doesn't need it to be more than 
+        # snapshot_max_age seconds old. Set to None whenever the worker changes the state of the device.
+        self.snapshot = None
+        self.snapshot_lock = threading.RLock()
+        self.run_finished_time = None
 
         # Misc other stuff 
         self.status_check_timer = {'modify': False, 'period': 1000}
         self.run_aborted = False
 
+        # Notifications are read as soon as they arrive by a background thread, rather than when the tab next polls check_status.
+        # The end of a run is posted straight to the tab (see NarwhalDevicesPulseGeneratorTab.wait_for_run_finished), and waits
+        # are handed to the wait monitor thread. Everything is also recorded in a fixed size buffer, which check_status reads so 
+        # the GUI can display it (or a summary of it, if there are lots), so many notifications can't use up all the memory.
+        self.run_finished = zprocess.Event(f'{self.device_name}_run_finished', type='post')
+        self.notification_buffer = NotificationBuffer(self.notification_buffer_size, n_addresses=2**16) # addresses are 16 bits
+        self.wait_start_instructions = {}
+        self.wait_end_instructions = {}
+        # Every notification of the current shot, if the shot asked for them to be saved. Swapped in and out under the lock.
+        self.notification_log = None
+        self.notification_log_lock = threading.Lock()
+        # Waits are monitored by their own thread, so wait_completed is posted, and timed out waits are restarted, without delay
+        self.wait_notifications = queue.Queue()
+        self.wait_lock = threading.Lock()
+        self.wait_monitor_running = True
+        self.wait_monitor = threading.Thread(target=self.monitor_waits, daemon=True)
+        self.wait_monitor.start()
+        self.notification_reader_running = True
+        self.notification_reader = threading.Thread(target=self.read_notifications, daemon=True)
+        self.notification_reader.start()
+
     def start_run(self):
         # method for starting the shot via a software trigger to the device.
         # The method name and return values should match those used in the 
         # associated BLACS GUI methods (which can be anything the developer wishes).
         print('called blacs_workers.NarwhalDevicesPulseGeneratorWorker.start_run')
+        self.snapshot = None
 
         # I need to figure out if this is only called for the master pseudoclock. If is is not called for the slaves, then I need to set software_run_enable=True
         # at the end of the transition_to_buffered function.
         self.started = True
         self.pg.write_action(trigger_now=True)
+        # The tab waits for the run_finished event with this identifier
+        return self.h5_file
+
+    def read_notifications(self):
+        # Runs in its own thread for the life of the worker. An error processing one notification is logged, and doesn't
+        # stop the notifications after it from being read.
+        notification_queue = self.pg.msgin_queues['notification']
+        while self.notification_reader_running:
+            try:
+                notification = notification_queue.get(timeout=1)
+            except queue.Empty:
+                continue
+            try:
+                self.process_notification(notification)
+            except Exception:
+                self.logger.exception(f'Could not process notification {notification}')
+
+    def process_notification(self, notification):
+        run_finished = notification['finished_notify'] and self.started
+        try:
+            if notification['address_notify']:
+                self.wait_notifications.put(notification)
+            # Anything the Pulse Generator notifies us about means its state has changed
+            self.snapshot = None
+            if run_finished:
+                self.run_finished_time = time.monotonic()
+                self.run_finished.post(self.h5_file)
+                run_finished = False
+            # The GUI always gets told about these, even if it is only sent a summary of the rest
+            important = (notification['trigger_notify'] or notification['finished_notify'] 
+                         or notification['address'] in self.wait_start_instructions or notification['address'] in self.wait_end_instructions)
+            self.notification_buffer.append(notification, important)
+            with self.notification_log_lock:
+                if self.notification_log is not None:
+                    self.notification_log.append(notification)
+        finally:
+            if run_finished:
+                # Something went wrong before the tab was told. Tell it anyway, or it will wait for the run to finish forever.
+                self.run_finished.post(self.h5_file)
+
+    def monitor_waits(self):
+        # Runs in its own thread for the life of the worker. Processes wait notifications as soon as they arrive, and
+        # restarts the Pulse Generator the moment a wait times out, rather than the next time the tab polls check_status.
+        # An error is logged, and doesn't stop the waits after it from being monitored.
+        while self.wait_monitor_running:
+            try:
+                with self.wait_lock:
+                    timeout_time = self.timeout_time
+                # Sleep until the next notification, or the wait times out. Wake up at least every second to check if we should stop.
+                block_time = 1 if timeout_time is None else min(1, max(0, timeout_time - time.monotonic()))
+                try:
+                    notification = self.wait_notifications.get(timeout=block_time)
+                except queue.Empty:
+                    notification = None
+                with self.wait_lock:
+                    if notification is not None:
+                        self.process_wait_notification(notification)
+                    elif self.timeout_time is not None and time.monotonic() >= self.timeout_time:
+                        self.retrigger_timed_out_wait()
+            except Exception:
+                self.logger.exception('Error monitoring waits')
+
+    def stop_monitoring_waits(self):
+        # Called whenever a shot ends, is aborted, or a new one is set up, so that a wait timeout left over from one shot 
+        # can never retrigger the next one. Takes the wait_lock, so the wait monitor can't be part way through a retrigger.
+        with self.wait_lock:
+            self.started = False
+            self.timeout_time = None
+            self.timeout_address = None
+
+    def retrigger_timed_out_wait(self):
+        # waiting for too long, restart the pulse generator
+        self.timeout_time = None
+        if not self.started or self.wait_timeout is None:
+            return
+        # Nothing else writes to the device during a run without the snapshot_lock, so hold it until the trigger is sent
+        with self.snapshot_lock:
+            state = self.get_snapshot(max_age=0)[0] # Try and avoid the race condition by looking at the state imeadiately before retriggering
+            if state is not None and state['running'] == False and state['current_address'] == self.timeout_address:
+                self.pg.write_action(trigger_now=True)
+                self.snapshot = None
+                self.wait_timeout[self.current_wait] = True
+
+    def process_wait_notification(self, notification):
+        # Check notifications for addresses corresponding to waits. Yes, this is more complex than it needs to be.
+        if not (self.started and self.wait_table is not None and self.current_wait < len(self.wait_table)):
+            return
+        address = notification['address']
+        if address in self.wait_start_instructions:
+            self.wait_start_instructions[address]['run_time'] = notification['run_time']
+            self.timeout_time = time.monotonic() + self.wait_start_instructions[address]['wait_timeout']
+            self.timeout_address = address
+        if address in self.wait_end_instructions:
+            try:
+                wait_start_instruction = self.wait_start_instructions[self.wait_end_instructions[address]['start_address']]
+                wait_duration = notification['run_time'] - wait_start_instruction['run_time'] - wait_start_instruction['instruction_duration']
+                self.measured_waits[self.current_wait] = wait_duration*10E-9
+            finally:
+                # Inform any interested parties that a wait has completed (even if its duration couldn't be measured):
+                self.wait_completed.post(self.h5_file, data=_ensure_str(self.wait_table[self.current_wait]["label"]),)
+                self.current_wait += 1
+                self.timeout_time = None
+                if self.current_wait == len(self.wait_table):
+                    self.all_waits_finished.post(self.h5_file)
+
+    def get_snapshot(self, max_age=None, timeout=0.1):
+        '''Returns the (state, powerline_state, state_extras) of the Pulse Generator, which are requested together and
+        arrive in a single round trip. If the last snapshot is less than max_age seconds old (default snapshot_max_age), it
+        is returned without any serial traffic. Any of them are None if the device didn't reply within timeout seconds.'''
+        if max_age is None:
+            max_age = self.snapshot_max_age
+        with self.snapshot_lock:
+            snapshot = self.snapshot
+            if snapshot is not None and time.monotonic() - snapshot['time'] <= max_age:
+                return snapshot['state'], snapshot['powerline_state'], snapshot['state_extras']
+            state_queues = [self.pg.msgin_queues['devicestate'], self.pg.msgin_queues['powerlinestate'], self.pg.msgin_queues['devicestate_extras']]
+            #Empty the state queues incase there is old data in them
+            for state_queue in state_queues:
+                state_queue.queue.clear()
+            request_time = time.monotonic()
+            self.pg.write_action(request_state=True, request_powerline_state=True, request_state_extras=True)
+            # The replies arrive together, so wait for all of them with one timeout, rather than one timeout each
+            replies = []
+            for state_queue in state_queues:
+                try:
+                    replies.append(state_queue.get(timeout=max(0, request_time + timeout - time.monotonic())))
+                except queue.Empty as ex:
+                    replies.append(None)
+            if None not in replies:
+                self.snapshot = {'time': request_time, 'state': replies[0], 'powerline_state': replies[1], 'state_extras': replies[2]}
+            return tuple(replies)
 
     def get_device_info(self):
         # This is called only once by blacs_tabs.py so it can display the hardware/firmware versions etc
         return self.device_info
 
-    def check_status(self):
+    def check_status(self, get_state=True):
         # method for checking whether the shot has completed.
         # The method name and return values should match those used in the 
         # associated BLACS GUI methods (which can be anything the developer wishes).
         print('called blacs_workers.NarwhalDevicesPulseGeneratorWorker.check_status')
         # I think I can return the full device status here, and I can choose what will be run in the main process (to update gui elements for example)
-        # print_calling_chain()
         # but I don't know how often this will be called.
         '''But I think this is called very offen during a run. So I could just always have the "notigy on run finished" setting True, and listen
         for that (and everything else) and then return that as well as everything else'''
-        state_queue = self.pg.msgin_queues['devicestate']
-        powerline_state_queue = self.pg.msgin_queues['powerlinestate']
-        state_extras_queue = self.pg.msgin_queues['devicestate_extras']
-        #Empty the state queues incase there is old data in them
-        state_queue.queue.clear()
-        powerline_state_queue.queue.clear()
-        state_extras_queue.queue.clear()
-        #request the state
-        self.pg.write_action(request_state=True, request_powerline_state=True, request_state_extras=True)
-        try:
-            state = state_queue.get(timeout=0.1)
-        except queue.Empty as ex:
-            state = None
-        try:
-            powerline_state = powerline_state_queue.get(timeout=0.1)
-        except queue.Empty as ex:
-            powerline_state = None
-        try:
-            state_extras = state_extras_queue.get(timeout=0.1)
-        except queue.Empty as ex:
-            state_extras = None
+        # The GUI doesn't always need the state (see NarwhalDevicesPulseGeneratorTab.gui_refresh_interval), so don't ask the device for it
+        if get_state:
+            state, powerline_state, state_extras = self.get_snapshot()
+        else:
+            state, powerline_state, state_extras = None, None, None
         # Check for a notification. We mainly want to know if finished=True
-        # Lots of notifications might possibly be sent, and any of them may contain a Finished=True. For now, just send them all.
-        notifications = []
-        try:
-            while True:
-                notifications.append(self.pg.msgin_queues['notification'].get(block=False))
-        except queue.Empty as ex:
-            pass
+        # Lots of notifications might possibly be sent. If there are too many to display, only the important ones 
+        # (which includes finished=True) are sent, along with a summary of the rest.
+        notifications, notification_summary = self.notification_buffer.read(self.gui_notification_limit, self.gui_summary_addresses)
         pg_comms_in_errors = [] 
         try:
             while True:
@@ -132,40 +390,17 @@ class NarwhalDevicesPulseGeneratorWorker(Worker):
         run_aborted_local = self.run_aborted
         self.run_aborted = False
 
-        # Check notifications for addresses corresponding to waits. Yes, this is more complex than it needs to be.
-        if (self.started and self.wait_table is not None and self.current_wait < len(self.wait_table)):
-            for notification in notifications:
-                if notification['address_notify']:
-                    address = notification['address']
-                    if address in self.wait_start_instructions:
-                        self.wait_start_instructions[address]['run_time'] = notification['run_time']
-                        self.timeout_time = time.time() + self.wait_start_instructions[address]['wait_timeout']
-                        self.timeout_address = address
-                    if address in self.wait_end_instructions:
-                        wait_start_instruction = self.wait_start_instructions[self.wait_end_instructions[address]['start_address']]
-                        wait_duration = notification['run_time'] - wait_start_instruction['run_time'] - wait_start_instruction['instruction_duration']
-                        self.measured_waits[self.current_wait] = wait_duration*10E-9
-                        # Inform any interested parties that a wait has completed:
-                        self.wait_completed.post(self.h5_file, data=_ensure_str(self.wait_table[self.current_wait]["label"]),)
-                        self.current_wait += 1
-                        self.timeout_time = None
-
-        if self.timeout_time is not None and time.time() >= self.timeout_time:
-            # waiting for too long, restart the pulse generator
-            self.timeout_time = None
-            state = self.pg.get_state() # Try and avoid the race condition by looking at the state imeadiately before retriggering
-            if state['running'] == False and state['current_address'] == self.timeout_address:
-                self.pg.write_action(trigger_now=True)
-                self.wait_timeout[self.current_wait] = True
-            
-        return state, powerline_state, state_extras, notifications, pg_comms_in_errors, bytesdropped, status_check_timer_local, run_aborted_local
+        return state, powerline_state, state_extras, notifications, notification_summary, pg_comms_in_errors, bytesdropped, status_check_timer_local, run_aborted_local
 
 
     def shutdown(self):
         # Once off device shutdown code called when the
         # BLACS exits
         print('called blacs_workers.NarwhalDevicesPulseGeneratorWorker.shutdown')
-        pass
+        self.notification_reader_running = False
+        self.wait_monitor_running = False
+        self.notification_reader.join()
+        self.wait_monitor.join()
         
 
     def program_manual(self , front_panel_values):
@@ -176,6 +411,7 @@ class NarwhalDevicesPulseGeneratorWorker(Worker):
         # return a dictionary of coerced / quantised values for each
         # channel , keyed by the channel name (or an empty dictionary )
         print('called blacs_workers.NarwhalDevicesPulseGeneratorWorker.program_manual')
+        self.snapshot = None
         self.pg.write_static_state([val for val in front_panel_values.values()])
         return {}
 
@@ -197,14 +433,18 @@ class NarwhalDevicesPulseGeneratorWorker(Worker):
         # maintain output continuity when we return to manual mode
         # after the shot completes .
         print('called blacs_workers.NarwhalDevicesPulseGeneratorWorker.transition_to_buffered')
+        self.snapshot = None
+        self.run_finished_time = None   # Set by read_notifications when this shot finishes
 
-        self.status_check_timer = {'modify': True, 'period': 100}
-        self.started = False    # Shouldn't be needed,, but does no harm
+        # The end of the run is posted by read_notifications, so the status only needs to be checked often enough to keep the GUI fresh
+        self.status_check_timer = {'modify': True, 'period': 500}
+        self.stop_monitoring_waits()    # Clears any wait timeout left over from the last shot
 
-        initial_channel_state = np.zeros(24, dtype=np.int8)
+        # The GUI values, packed into a state word in the same way as the PULSE_PROGRAM (bit n is channel n)
+        initial_state = np.uint32(0)
         for channel_label, channel_state in initial_values.items():
             channel = int(channel_label.split()[1])
-            initial_channel_state[channel] = int(channel_state)
+            initial_state |= np.uint32(bool(channel_state) << channel)
         
         # needed for saving data at the end of the run
         self.h5_file = h5file
@@ -246,36 +486,33 @@ class NarwhalDevicesPulseGeneratorWorker(Worker):
 
 
             # It is not required that all channels be assigned in the labscript file. Any that aren't, keep them at the value on the GUI
-            instruction_0_channel_state = pulse_program[0]['channel_state']
-            unspecified_channels_index = instruction_0_channel_state == -1
-            unspecified_channels_state = initial_channel_state[unspecified_channels_index]
-            
-            wait_idx = 0
-            instructions = []
-            for instruction in pulse_program:
-
-                #Any unasigned channels get the value on the GUI
-                channel_state = instruction['channel_state']
-                channel_state[unspecified_channels_index] = unspecified_channels_state
-
-                encoded_instruction = ndpulsegen.encode_instruction(address=instruction['address'], duration=instruction['duration'], 
-                                                            state=channel_state, goto_address=instruction['goto_address'], 
-                                                            goto_counter=instruction['goto_counter'], stop_and_wait=instruction['stop_and_wait'], 
-                                                            hardware_trig_out=instruction['hardware_trig_out'], notify_computer=instruction['notify_computer'], 
-                                                            powerline_sync=instruction['powerline_sync'])
-                instructions.append(encoded_instruction)
-
-                # For stop and wait instructions, record the address of both the wait_start instruction, and the wait_end instruction (which is probably just +1)
-                if is_wait_monitor and instruction['stop_and_wait']:
-                    self.wait_start_instructions[instruction['address']] = {'wait_index':wait_idx, 
-                                                                            'instruction_duration':instruction['duration'],
-                                                                            'wait_timeout':self.wait_table[wait_idx][2] + instruction['duration']*10E-9}
-                    if instruction['goto_counter'] == 0:
-                        end_address = instruction['address'] + 1
-                    else:
-                        end_address = instruction['goto_address']
-                    self.wait_end_instructions[end_address] = {'start_address':instruction['address']}
-                    wait_idx +=1 
+            pulse_program['state'] = (pulse_program['state'] & pulse_program['state_specified']) | (initial_state & ~pulse_program['state_specified'])
+
+            # The GUI values are uploaded as part of the instructions, so they have to match as well as the compiled instructions
+            program_id = (self.device_properties.get('pulse_program_hash', None), int(initial_state))
+            if not fresh and program_id[0] is not None and self.smart_cache['program_id'] == program_id:
+                # The last shot uploaded exactly the same instructions, so there is no need to even look at them
+                instructions = None
+            elif 'PULSE_PROGRAM_ENCODED' in group:
+                # The instructions were encoded when the shot was compiled. Only the output state needs to be filled in, since it depends on the GUI values.
+                instructions = group['PULSE_PROGRAM_ENCODED'][:]
+                instructions.view(instruction_message_dtype)['state'] = pulse_program['state'].astype('<u4').view(np.uint8).reshape(-1, 1, 4)[:, :, :3]
+            else:
+                # Shot files compiled before the encoded instructions were saved
+                instructions = encode_instructions(pulse_program)
+
+            # For stop and wait instructions, record the address of both the wait_start instruction, and the wait_end instruction (which is probably just +1)
+            if is_wait_monitor:
+                if 'WAIT_ADDRESSES' in group:
+                    wait_addresses = group['WAIT_ADDRESSES'][:]
+                else:
+                    # Shot files compiled before the wait addresses were saved
+                    wait_addresses = find_wait_addresses(pulse_program)
+                wait_timeouts = self.wait_table['timeout'] + wait_addresses['start_duration']*10E-9
+                for wait_idx, (start_address, end_address, start_duration, wait_timeout) in enumerate(zip(wait_addresses['start_address'].tolist(), wait_addresses['end_address'].tolist(), 
+                                                                                                          wait_addresses['start_duration'].tolist(), wait_timeouts.tolist())):
+                    self.wait_start_instructions[start_address] = {'wait_index':wait_idx, 'instruction_duration':start_duration, 'wait_timeout':wait_timeout}
+                    self.wait_end_instructions[end_address] = {'start_address':start_address}
                 
             final_instr = pulse_program[-1]
 
@@ -284,16 +521,20 @@ class NarwhalDevicesPulseGeneratorWorker(Worker):
         
         # blacs requires the expected final state to be returned from this function
         final_values = {}
-        for channel, channel_state in enumerate(final_instr['channel_state']):
-            final_values[f'channel {channel}'] = channel_state
+        for channel in range(self.num_DO):
+            final_values[f'channel {channel}'] = (int(final_instr['state']) >> channel) & 1
         
 
+        # Start a new log of notifications if this shot wants them saved
+        with self.notification_log_lock:
+            self.notification_log = NotificationLog(self.notification_log_chunk_size) if self.device_properties.get('record_notifications', False) else None
+
         # Since the Pulse Generator could technically be running (if, for example, someone was playing around with the manual mode)
         # We reset it so it is in a known state. It does no harm to be safe.
         self.pg.write_device_options(accept_hardware_trigger='never')
         self.pg.write_action(reset_run=True)
 
-        self.pg.write_instructions(instructions)
+        self.write_instructions_smart(pulse_program['address'], instructions, fresh, program_id)
         self.pg.write_powerline_trigger_options(trigger_on_powerline=self.device_properties["trigger_on_powerline"], powerline_trigger_delay=int(np.round(self.device_properties["powerline_trigger_delay"]/10E-9)))
 
         # The main difference (so far) is that the master pseudoclock has its software_enable set to false, to enforce it waiting for a software trigger (ignore any hardware triggers it might recieve)
@@ -306,6 +547,30 @@ class NarwhalDevicesPulseGeneratorWorker(Worker):
         return final_values
 
 
+    def write_instructions_smart(self, addresses, instructions, fresh, program_id=None):
+        '''Uploads the encoded instructions (one row per address), skipping any addresses that already hold exactly
+        the same instruction. Everything is uploaded if fresh is True, which BLACS sets when the "clear smart programming" 
+        button is pressed. instructions is None if the program identified by program_id is already uploaded.'''
+        if instructions is None:
+            self.logger.info(f'uploaded 0 of {len(addresses)} instructions (same program as the last shot)')
+            return
+        if fresh or self.smart_cache['instructions'] is None:
+            self.smart_cache['instructions'] = np.zeros((self.device_properties['max_instructions'], instructions.shape[1]), dtype=np.uint8)
+            self.smart_cache['uploaded'] = np.zeros(self.device_properties['max_instructions'], dtype=bool)
+            changed = np.ones(len(addresses), dtype=bool)
+        else:
+            changed = ~self.smart_cache['uploaded'][addresses] | (self.smart_cache['instructions'][addresses] != instructions).any(axis=1)
+        
+        # If the upload fails part way through, we don't know what is in the instruction memory, so forget everything until it succeeds.
+        cache, self.smart_cache = self.smart_cache, {'instructions': None, 'uploaded': None, 'program_id': None}
+        if changed.any():
+            self.pg.write_instructions(instructions[changed].tobytes())
+        cache['instructions'][addresses[changed]] = instructions[changed]
+        cache['uploaded'][addresses[changed]] = True
+        cache['program_id'] = program_id
+        self.smart_cache = cache
+        self.logger.info(f'uploaded {changed.sum()} of {len(addresses)} instructions')
+
     def transition_to_manual(self):
         """Transition the NDPG back to manual mode from buffered execution at
         the end of a shot.
@@ -315,7 +580,8 @@ class NarwhalDevicesPulseGeneratorWorker(Worker):
         """
 
         print('called blacs_workers.NarwhalDevicesPulseGeneratorWorker.transition_to_manual')
-        self.started = False
+        # The snapshot isn't cleared here, so that one taken since the run finished (eg. by check_status) can be reused below
+        self.stop_monitoring_waits()
         with h5py.File(self.h5_file, "a") as hdf5_file:
             # Save some device info while you have access to the hdf file
             NDPG_group = hdf5_file[f'/devices/{self.device_name}']
@@ -344,8 +610,17 @@ class NarwhalDevicesPulseGeneratorWorker(Worker):
 
                 self.wait_durations_analysed.post(self.h5_file)
 
-        state = self.pg.get_state()
-        if state['running'] == False and state['current_address'] == self.final_instruction_address:
+            # Save the log of notifications, if this shot recorded one
+            with self.notification_log_lock:
+                notification_log, self.notification_log = self.notification_log, None
+            if notification_log is not None:
+                notification_log.write(hdf5_file.require_group(f'/data/{self.device_name}'), 'NOTIFICATIONS')
+
+        # Any snapshot taken after this shot finished will do
+        max_age = 0 if self.run_finished_time is None else time.monotonic() - self.run_finished_time
+        state = self.get_snapshot(max_age=max_age)[0]
+        self.snapshot = None
+        if state is not None and state['running'] == False and state['current_address'] == self.final_instruction_address:
             self.pg.write_device_options(accept_hardware_trigger='never')   # Should automatically be placed back in this mode, but does no harm.
             self.pg.write_action(reset_run=True) # Should not be needed. But does no harm.
             return True
@@ -357,7 +632,10 @@ class NarwhalDevicesPulseGeneratorWorker(Worker):
         # shot is aborted prior to the initial trigger
         # return True on success
         print('called blacs_workers.NarwhalDevicesPulseGeneratorWorker.abort_transition_to_buffered')
-        self.started = False
+        self.snapshot = None
+        self.stop_monitoring_waits()
+        with self.notification_log_lock:
+            self.notification_log = None    # Nothing to save it to
         self.pg.write_device_options(accept_hardware_trigger='never')
         self.pg.write_action(reset_run=True) # Should not be required, unless the device was triggered by a hardware trigger before we could disallow it.
         self.status_check_timer = {'modify': True, 'period': 1000}
@@ -369,7 +647,10 @@ class NarwhalDevicesPulseGeneratorWorker(Worker):
         # the execution of the shot ( after the initial trigger )
         # return True on success
         print('called blacs_workers.NarwhalDevicesPulseGeneratorWorker.abort_buffered')
-        self.started = False
+        self.snapshot = None
+        self.stop_monitoring_waits()
+        with self.notification_log_lock:
+            self.notification_log = None    # Nothing to save it to
         self.pg.write_device_options(accept_hardware_trigger='never')
         self.pg.write_action(reset_run=True)
         self.status_check_timer = {'modify': True, 'period': 1000}
@@ -383,7 +664,7 @@ class NarwhalDevicesPulseGeneratorWorker(Worker):
 
         # It would be nice to extend this to get all the state of the device and update the GUI, but the function that calls this 
         # can only update the channel values.
-        device_state = self.pg.get_state()
+        device_state = self.get_snapshot()[0]
         if device_state is None:
             raise Exception('Pulse Generator failed to return its current state. ' 
                             'A likely cause is the host computer failing to read all the messages sent to it. '
@@ -398,51 +679,54 @@ class NarwhalDevicesPulseGeneratorWorker(Worker):
     def set_disable_after_current_run(self):
         #I need to check the FPGA code to see if this does anything when running is not true, and when run_mode is single.
         print('called blacs_workers.NarwhalDevicesPulseGeneratorWorker.set_disable_after_current_run')
+        self.snapshot = None
         self.pg.write_action(disable_after_current_run=True)
 
     def set_run_enable_software(self, enabled):
         print('called blacs_workers.NarwhalDevicesPulseGeneratorWorker.set_run_enable_software')
+        self.snapshot = None
         self.pg.write_device_options(software_run_enable=enabled)
 
     def set_runmode(self, runmode):
         print('called blacs_workers.NarwhalDevicesPulseGeneratorWorker.set_runmode')
+        self.snapshot = None
         self.pg.write_device_options(run_mode=runmode)
 
     def set_accept_hardware_trigger(self, accept_hardware_trigger):
         print('called blacs_workers.NarwhalDevicesPulseGeneratorWorker.set_accept_hardware_trigger')
+        self.snapshot = None
         self.pg.write_device_options(accept_hardware_trigger=accept_hardware_trigger)
 
     def set_waitforpowerline(self, waitforpowerline):
         print('called blacs_workers.NarwhalDevicesPulseGeneratorWorker.set_waitforpowerline')
+        self.snapshot = None
         self.pg.write_powerline_trigger_options(trigger_on_powerline=waitforpowerline)
 
     def set_powerlinedelay(self, powerlinedelay):
         print('called blacs_workers.NarwhalDevicesPulseGeneratorWorker.set_powerlinedelay')
+        self.snapshot = None
         self.pg.write_powerline_trigger_options(powerline_trigger_delay=powerlinedelay)
 
     def set_triggerduration(self, triggerduration):
         print('called blacs_workers.NarwhalDevicesPulseGeneratorWorker.set_triggerduration')
+        self.snapshot = None
         self.pg.write_device_options(trigger_out_length=triggerduration)
 
     def set_triggerdelay(self, triggerdelay):
         print('called blacs_workers.NarwhalDevicesPulseGeneratorWorker.set_triggerdelay')
+        self.snapshot = None
         self.pg.write_device_options(trigger_out_delay=triggerdelay)
 
     def set_notifyfinished(self, notifyfinished):
         print('called blacs_workers.NarwhalDevicesPulseGeneratorWorker.set_notifyfinished')
+        self.snapshot = None
         self.pg.write_device_options(notify_when_run_finished=notifyfinished)
 
     def set_notifytrigout(self, notifytrigout):
         print('called blacs_workers.NarwhalDevicesPulseGeneratorWorker.set_notifytrigout')
+        self.snapshot = None
         self.pg.write_device_options(notify_on_main_trig_out=notifytrigout)
 
-def print_calling_chain():
-    current_frame = inspect.currentframe()
-    while current_frame:
-        frame_info = inspect.getframeinfo(current_frame)
-        print(f"Function: {frame_info.function} | File: {frame_info.filename} | Line number: {frame_info.lineno}")
-        current_frame = current_frame.f_back
-
     # core_clock_freq = 100
     # def init(self):
     #     exec('from spinapi import *', globals())
@@ -0,0 +1,461 @@
+'''A software Pulse Generator, which can be used in place of ndpulsegen.PulseGenerator when there is no hardware (for
+benchmarks, and testing the BLACS worker, wait monitor and shot cycle). It has the same msgin_queues and write_* methods
+as the parts of ndpulsegen.PulseGenerator that the worker uses, and executes the loaded instructions with the same
+goto_counter, stop_and_wait, notify, powerline_sync and final_address semantics.
+
+Time is counted in 10ns clock cycles on a virtual clock, which runs at speed times real time, or as fast as possible
+if speed is None (then a run only takes as long as it takes to step through its instructions, and stops only for waits
+and triggers). The serial link can optionally have a baudrate, which makes writes block for as long as it would take to
+send them, and a latency, which delays when commands take effect and when replies arrive.
+
+Triggers: trigger_now (software) always starts a run, or ends a wait. Hardware triggers come from hardware_trigger(), or
+every hardware_trigger_interval seconds (of virtual time) if that is set, and only count if accept_hardware_trigger is
+not 'never' and software_run_enable is True. 'once' goes back to 'never' after one hardware trigger, and 'single_run'
+after the run finishes.'''
+
+import time
+import heapq
+import queue
+import threading
+import numpy as np
+from .transcode import decode_instructions, instruction_tags
+
+clock_period = 10E-9
+'''Seconds per clock cycle.'''
+
+n_addresses = 8192
+'''Size of the instruction memory.'''
+
+n_channels = 24
+
+message_lengths = {'echo': 2, 'device_options': 14, 'powerline_trigger_options': 5, 'action': 2, 'static_state': 4, 'general_debug': 9,
+                   'devicestate': 18, 'powerlinestate': 8, 'devicestate_extras': 10, 'notification': 11, 'error': 4}
+'''Approximate length in bytes of each message (the instructions are sent as they are), only used to work out how
+long they take to send when a baudrate is given.'''
+
+tag_bits = dict(instruction_tags)
+event_tags = (1 << tag_bits['stop_and_wait']) | (1 << tag_bits['hardware_trig_out']) | (1 << tag_bits['notify_computer']) | (1 << tag_bits['powerline_sync'])
+'''Instructions with any of these tags do something other than output their state, so loops with them in are never fast forwarded.'''
+
+
+class EmulatedSerial(object):
+    '''Stands in for the serial.Serial of ndpulsegen.PulseGenerator. Only the port name is used.'''
+    def __init__(self, port):
+        self.port = port
+
+
+class EmulatedPulseGenerator(object):
+    '''Drop in replacement for ndpulsegen.PulseGenerator. See the module docstring.'''
+
+    device_type = 1
+
+    max_steps = 100000
+    '''The most instructions stepped through before the lock is released, so commands are never held up for long.'''
+
+    def __init__(self, speed=1.0, baudrate=None, latency=0, hardware_trigger_interval=None, powerline_frequency=50.0,
+                 firmware_version='emulated', hardware_version='emulated'):
+        self.speed = speed
+        self.baudrate = baudrate
+        self.latency = latency
+        self.hardware_trigger_interval = None if hardware_trigger_interval is None else max(1, int(round(hardware_trigger_interval/clock_period)))
+        self.powerline_period = int(round(1/(powerline_frequency*clock_period)))
+        self.firmware_version = firmware_version
+        self.hardware_version = hardware_version
+        self.ser = EmulatedSerial('emulated')
+
+        self.msgin_queues = {message_type: queue.Queue() for message_type in ['echo', 'devicestate', 'powerlinestate', 'devicestate_extras', 'notification', 'error', 'print', 'bytes_dropped']}
+
+        # Everything below is only touched with the condition held
+        self.condition = threading.Condition()
+        self.commands = []      # heap of (host time the command takes effect, sequence number, function, kwargs)
+        self.replies = []       # heap of (host time the reply arrives, sequence number, queue name, message)
+        self.sequence = 0
+        self.line_free = 0      # host time the serial link to the device finishes sending everything written so far
+        self.running_thread = False
+
+        # The instruction memory, and the remaining repetitions of each loop
+        self.ram_state = np.zeros(n_addresses, dtype=np.int64)
+        self.ram_duration = np.ones(n_addresses, dtype=np.int64)
+        self.ram_goto_address = np.zeros(n_addresses, dtype=np.int64)
+        self.ram_goto_counter = np.zeros(n_addresses, dtype=np.int64)
+        self.ram_tags = np.zeros(n_addresses, dtype=np.int64)
+        self.counters = np.zeros(n_addresses, dtype=np.int64)
+
+        # Settings
+        self.final_address = 0
+        self.run_mode = 'single'
+        self.accept_hardware_trigger = 'never'
+        self.trigger_out_length = 1
+        self.trigger_out_delay = 0
+        self.notify_on_main_trig_out = False
+        self.notify_on_run_finished = False
+        self.software_run_enable = True
+        self.trig_on_powerline = False
+        self.powerline_trigger_delay = 0
+        self.disable_after_current_run = False
+
+        # What the device is doing. phase is one of 'idle', 'running', 'waiting' (after a stop_and_wait) or 'finished'
+        self.phase = 'idle'
+        self.output = 0
+        self.address = 0
+        self.instruction_end = 0
+        self.pending = None     # (clock, address, new_run) of an instruction that starts later (on a powerline trigger)
+        self.wait_address = 0   # where the run carries on from when a wait ends
+        self.armed_since = 0    # when the device started waiting for a trigger
+        self.run_start = 0
+        self.run_end = 0
+        self.event_count = 0
+        self.loop_marks = {}    # address -> (clock, remaining, event_count) the last time that loop went back
+        self.clock = 0          # virtual clock (cycles) that execution has been brought up to
+        self.start_time = time.monotonic()
+
+    ######################### Connection
+    def connect(self, serial_number=None):
+        self.serial_number = 0 if serial_number is None else serial_number
+        self.start_time = time.monotonic()
+        self.running_thread = True
+        self.emulation_thread = threading.Thread(target=self.emulate, daemon=True)
+        self.emulation_thread.start()
+
+    def disconnect(self):
+        with self.condition:
+            self.running_thread = False
+            self.condition.notify_all()
+        self.emulation_thread.join()
+        for q in self.msgin_queues.values():
+            q.queue.clear()
+
+    def get_connected_devices(self):
+        return {'validated_devices': [{'device_type': self.device_type, 'serial_number': getattr(self, 'serial_number', 0), 'comport': self.ser.port}],
+                'unvalidated_devices': []}
+
+    ######################### Write command functions
+    def write_command(self, n_bytes, function, **kwargs):
+        '''Sends a command to the emulated device. If there is a baudrate, this blocks until it is sent (like a write
+        to a full serial buffer would), and it only takes effect latency seconds after that.'''
+        with self.condition:
+            now = time.monotonic()
+            transfer_time = 0 if self.baudrate is None else n_bytes*10/self.baudrate
+            self.line_free = max(now, self.line_free) + transfer_time
+            sent_time = self.line_free
+            heapq.heappush(self.commands, (sent_time + self.latency, self.sequence, function, kwargs))
+            self.sequence += 1
+            self.condition.notify_all()
+        if sent_time > now:
+            time.sleep(sent_time - now)
+
+    def write_echo(self, byte_to_echo):
+        self.write_command(message_lengths['echo'], self.apply_echo, byte_to_echo=byte_to_echo)
+
+    def write_device_options(self, final_address=None, run_mode=None, accept_hardware_trigger=None, trigger_out_length=None, trigger_out_delay=None,
+                             notify_on_main_trig_out=None, notify_when_run_finished=None, software_run_enable=None):
+        if run_mode not in (None, 'single', 'continuous'):
+            raise ValueError(f'run_mode must be \'single\' or \'continuous\', not {run_mode}')
+        if accept_hardware_trigger not in (None, 'never', 'always', 'single_run', 'once'):
+            raise ValueError(f'accept_hardware_trigger must be \'never\', \'always\', \'single_run\' or \'once\', not {accept_hardware_trigger}')
+        options = {'final_address': final_address, 'run_mode': run_mode, 'accept_hardware_trigger': accept_hardware_trigger, 'trigger_out_length': trigger_out_length,
+                   'trigger_out_delay': trigger_out_delay, 'notify_on_main_trig_out': notify_on_main_trig_out, 'notify_on_run_finished': notify_when_run_finished,
+                   'software_run_enable': software_run_enable}
+        self.write_command(message_lengths['device_options'], self.apply_settings, **options)
+
+    def write_powerline_trigger_options(self, trigger_on_powerline=None, powerline_trigger_delay=None):
+        self.write_command(message_lengths['powerline_trigger_options'], self.apply_settings, trig_on_powerline=trigger_on_powerline, powerline_trigger_delay=powerline_trigger_delay)
+
+    def write_action(self, trigger_now=False, disable_after_current_run=False, reset_run=False, request_state=False, request_powerline_state=False, request_state_extras=False):
+        self.write_command(message_lengths['action'], self.apply_action, trigger_now=trigger_now, disable_after_current_run=disable_after_current_run, reset_run=reset_run,
+                           request_state=request_state, request_powerline_state=request_powerline_state, request_state_extras=request_state_extras)
+
+    def write_general_debug(self, message):
+        self.write_command(message_lengths['general_debug'], lambda: None)
+
+    def write_static_state(self, state):
+        self.write_command(message_lengths['static_state'], self.apply_static_state, state=state)
+
+    def write_instructions(self, instructions):
+        if isinstance(instructions, (list, tuple, np.ndarray)):
+            instructions = b''.join([bytes(instruction) for instruction in instructions])
+        decoded = decode_instructions(instructions)
+        self.write_command(len(instructions), self.apply_instructions, decoded=decoded)
+
+    def hardware_trigger(self):
+        '''A pulse on the trigger input. Takes effect straight away (it doesn't go over the serial link).'''
+        with self.condition:
+            self.update()
+            self.trigger('hardware', self.clock)
+            self.condition.notify_all()
+
+    ######################### Like ndpulsegen.PulseGenerator
+    def get_state(self, timeout=None):
+        state_queue = self.msgin_queues['devicestate']
+        state_queue.queue.clear()
+        self.write_action(request_state=True)
+        try:
+            return state_queue.get(timeout=1)
+        except queue.Empty as ex:
+            return None
+
+    def get_powerline_state(self, timeout=None):
+        state_queue = self.msgin_queues['powerlinestate']
+        state_queue.queue.clear()
+        self.write_action(request_powerline_state=True)
+        try:
+            return state_queue.get(timeout=1)
+        except queue.Empty as ex:
+            return None
+
+    ######################### The emulated device. Everything from here down is called with the condition held.
+    def emulate(self):
+        # Runs in its own thread while connected
+        with self.condition:
+            while self.running_thread:
+                self.update()
+                self.condition.wait(self.sleep_time())
+
+    def host_to_clock(self, host_time):
+        return int((host_time - self.start_time)*self.speed/clock_period)
+
+    def clock_to_host(self, clock):
+        return self.start_time + clock*clock_period/self.speed
+
+    def update(self):
+        '''Applies every command that has arrived, runs the program up to now, and sends any replies that are due.'''
+        now = time.monotonic()
+        while self.commands and self.commands[0][0] <= now:
+            command_time, sequence, function, kwargs = heapq.heappop(self.commands)
+            if self.speed is not None:
+                self.advance(self.host_to_clock(command_time))
+            function(**kwargs)
+        self.advance(np.inf if self.speed is None else self.host_to_clock(now))
+        while self.replies and self.replies[0][0] <= now:
+            reply_time, sequence, queue_name, message = heapq.heappop(self.replies)
+            message['timestamp'] = time.time()
+            self.msgin_queues[queue_name].put(message)
+
+    def sleep_time(self):
+        '''How long the emulation thread can sleep before it has something to do (it is also woken by every command).'''
+        now = time.monotonic()
+        wake_times = [now + 0.1]
+        if self.commands:
+            wake_times.append(self.commands[0][0])
+        if self.replies:
+            wake_times.append(self.replies[0][0])
+        if self.speed is None:
+            if self.next_event() is not None:
+                wake_times.append(now)
+        else:
+            next_event = self.next_event()
+            if next_event is not None:
+                wake_times.append(self.clock_to_host(next_event))
+        return max(0, min(wake_times) - now)
+
+    def reply(self, queue_name, message):
+        transfer_time = 0 if self.baudrate is None else message_lengths[queue_name]*10/self.baudrate
+        heapq.heappush(self.replies, (time.monotonic() + self.latency + transfer_time, self.sequence, queue_name, message))
+        self.sequence += 1
+
+    def notify(self, clock, address, address_notify=False, trigger_notify=False, finished_notify=False):
+        self.reply('notification', {'address': int(address), 'address_notify': address_notify, 'trigger_notify': trigger_notify,
+                                    'finished_notify': finished_notify, 'run_time': int(clock - self.run_start)})
+
+    def accepting_hardware_triggers(self):
+        return self.accept_hardware_trigger != 'never' and self.software_run_enable
+
+    def next_hardware_trigger(self):
+        # The clock of the next emulated hardware trigger, if the device is waiting for one
+        if self.hardware_trigger_interval is None or self.pending is not None or self.phase == 'running' or not self.accepting_hardware_triggers():
+            return None
+        return -(-self.armed_since//self.hardware_trigger_interval)*self.hardware_trigger_interval
+
+    def next_event(self):
+        # The clock of the next thing the program will do on its own, if there is one
+        events = []
+        if self.pending is not None:
+            events.append(self.pending[0])
+        if self.phase == 'running':
+            events.append(self.instruction_end)
+        next_hardware_trigger = self.next_hardware_trigger()
+        if next_hardware_trigger is not None:
+            events.append(next_hardware_trigger)
+        return min(events) if events else None
+
+    def next_powerline_trigger(self, clock):
+        return -(-(clock - self.powerline_trigger_delay)//self.powerline_period)*self.powerline_period + self.powerline_trigger_delay
+
+    def advance(self, target):
+        '''Runs the program until the virtual clock reaches target (or until it has to stop, if target is infinite).'''
+        for step in range(self.max_steps):
+            next_event = self.next_event()
+            if next_event is None or next_event > target:
+                break
+            if self.pending is not None and self.pending[0] == next_event:
+                clock, address, new_run = self.pending
+                self.pending = None
+                if new_run:
+                    self.start_run(clock)
+                else:
+                    self.start_instruction(address, clock, synced=True)
+            elif self.phase == 'running' and self.instruction_end == next_event:
+                self.finish_instruction(target)
+            else:
+                self.trigger('hardware', next_event)
+        else:
+            # Still busy. Come back to it after the lock has been released.
+            return
+        if target != np.inf:
+            self.clock = max(self.clock, target)
+
+    def trigger(self, source, clock):
+        if source == 'hardware':
+            if not self.accepting_hardware_triggers():
+                return
+            if self.accept_hardware_trigger == 'once':
+                self.accept_hardware_trigger = 'never'
+        self.clock = max(self.clock, clock)
+        if self.pending is not None or self.phase == 'running':
+            # Already going
+            return
+        new_run = self.phase != 'waiting'
+        if self.trig_on_powerline:
+            self.pending = (self.next_powerline_trigger(clock), self.wait_address, new_run)
+        elif new_run:
+            self.start_run(clock)
+        else:
+            self.start_instruction(self.wait_address, clock)
+
+    def start_run(self, clock):
+        self.run_start = clock
+        self.counters[:] = self.ram_goto_counter
+        self.loop_marks = {}
+        if self.notify_on_main_trig_out:
+            self.notify(clock + self.trigger_out_delay, 0, trigger_notify=True)
+        self.start_instruction(0, clock)
+
+    def start_instruction(self, address, clock, synced=False):
+        tags = int(self.ram_tags[address])
+        self.clock = max(self.clock, clock)
+        if tags & (1 << tag_bits['powerline_sync']) and not synced:
+            self.phase = 'waiting'
+            self.pending = (self.next_powerline_trigger(clock), address, False)
+            return
+        self.phase = 'running'
+        self.address = address
+        self.output = int(self.ram_state[address])
+        self.instruction_end = clock + int(self.ram_duration[address])
+        if tags & event_tags:
+            self.event_count += 1
+        if tags & (1 << tag_bits['notify_computer']):
+            self.notify(clock, address, address_notify=True)
+        if tags & (1 << tag_bits['hardware_trig_out']) and self.notify_on_main_trig_out:
+            self.notify(clock + self.trigger_out_delay, address, trigger_notify=True)
+
+    def finish_instruction(self, target):
+        address, clock = self.address, self.instruction_end
+        self.clock = max(self.clock, clock)
+        next_address = address + 1
+        if self.ram_goto_counter[address] > 0:
+            remaining = int(self.counters[address])
+            if remaining > 0:
+                self.counters[address] = remaining - 1
+                next_address = int(self.ram_goto_address[address])
+                # If nothing happened in the last repetition but output states, every repetition until the loop finishes
+                # is exactly the same (any loops inside it start from the beginning each time), so skip ahead.
+                mark = self.loop_marks.get(address)
+                if mark is not None and mark[1] == remaining + 1 and mark[2] == self.event_count:
+                    period = clock - mark[0]
+                    skip = remaining - 1 if target == np.inf else min(remaining - 1, int((target - clock)//period))
+                    if skip > 0:
+                        clock += skip*period
+                        self.counters[address] -= skip
+                self.loop_marks[address] = (clock, int(self.counters[address]) + 1, self.event_count)
+            else:
+                # The loop has finished, so its counter starts again, ready for next time
+                self.counters[address] = self.ram_goto_counter[address]
+                self.loop_marks.pop(address, None)
+        if address == self.final_address and next_address == address + 1:
+            self.finish_run(clock)
+        elif self.ram_tags[address] & (1 << tag_bits['stop_and_wait']):
+            self.phase = 'waiting'
+            self.wait_address = next_address
+            self.armed_since = clock
+        else:
+            self.start_instruction(next_address, clock)
+
+    def finish_run(self, clock):
+        self.phase = 'finished'
+        self.run_end = clock
+        self.armed_since = clock
+        self.wait_address = 0
+        if self.notify_on_run_finished:
+            self.notify(clock, self.address, finished_notify=True)
+        if self.accept_hardware_trigger == 'single_run':
+            self.accept_hardware_trigger = 'never'
+        if self.run_mode == 'continuous' and not self.disable_after_current_run:
+            self.start_run(clock)
+        self.disable_after_current_run = False
+
+    def reset(self):
+        self.phase = 'idle'
+        self.pending = None
+        self.address = 0
+        self.wait_address = 0
+        self.armed_since = self.clock
+        self.run_start = self.run_end = self.clock
+        self.counters[:] = self.ram_goto_counter
+        self.loop_marks = {}
+
+    ######################### Commands, applied when they arrive at the emulated device
+    def apply_echo(self, byte_to_echo):
+        self.reply('echo', {'echoed_byte': byte_to_echo, 'device_type': self.device_type, 'hardware_version': self.hardware_version,
+                            'firmware_version': self.firmware_version, 'serial_number': self.serial_number})
+
+    def apply_settings(self, **settings):
+        for name, value in settings.items():
+            if value is not None:
+                setattr(self, name, value)
+        if self.phase != 'running':
+            # Waiting for a trigger from now on (if the device now accepts them)
+            self.armed_since = self.clock
+
+    def apply_action(self, trigger_now, disable_after_current_run, reset_run, request_state, request_powerline_state, request_state_extras):
+        if reset_run:
+            self.reset()
+        if disable_after_current_run:
+            self.disable_after_current_run = True
+        if trigger_now:
+            self.trigger('software', self.clock)
+        if request_state:
+            self.reply('devicestate', self.devicestate())
+        if request_powerline_state:
+            self.reply('powerlinestate', {'trig_on_powerline': self.trig_on_powerline, 'powerline_locked': True, 'powerline_period': self.powerline_period,
+                                          'powerline_trigger_delay': self.powerline_trigger_delay})
+        if request_state_extras:
+            run_time = self.run_end - self.run_start if self.phase in ('idle', 'finished') else self.clock - self.run_start
+            self.reply('devicestate_extras', {'run_time': int(run_time)})
+
+    def apply_static_state(self, state):
+        if self.phase in ('idle', 'finished'):
+            self.output = sum(bool(channel_state) << channel for channel, channel_state in enumerate(state))
+
+    def apply_instructions(self, decoded):
+        valid = decoded['address'] < n_addresses
+        if not valid.all():
+            self.reply('error', {'invalid_identifier': False, 'msg_not_forwarded': False, 'msg_receive_timeout': False, 'error_info': 'load_instruction'})
+            decoded = {name: values[valid] for name, values in decoded.items()}
+        addresses = decoded['address']
+        self.ram_state[addresses] = decoded['state']
+        self.ram_duration[addresses] = decoded['duration']
+        self.ram_goto_address[addresses] = decoded['goto_address']
+        self.ram_goto_counter[addresses] = decoded['goto_counter']
+        self.counters[addresses] = decoded['goto_counter']
+        tags = np.zeros(len(addresses), dtype=np.int64)
+        for name, bit in instruction_tags:
+            tags |= decoded[name].astype(np.int64) << bit
+        self.ram_tags[addresses] = tags
+
+    def devicestate(self):
+        return {'state': [(self.output >> channel) & 1 for channel in range(n_channels)], 'clock_source': 'internal',
+                'current_address': int(self.address), 'final_address': int(self.final_address), 'running': self.phase == 'running',
+                'software_run_enable': self.software_run_enable, 'hardware_run_enable': True, 'run_mode': self.run_mode,
+                'accept_hardware_trigger': self.accept_hardware_trigger, 'trigger_out_length': self.trigger_out_length,
+                'trigger_out_delay': self.trigger_out_delay, 'notify_on_main_trig_out': self.notify_on_main_trig_out,
+                'notify_on_run_finished': self.notify_on_run_finished}
@@ -14,6 +14,14 @@ from labscript import (
 )
 import numpy as np
 import time
+import hashlib
+from collections import OrderedDict
+from .transcode import encode_instructions, instruction_message_dtype, find_wait_addresses
+
+# Device instructions compiled for recent shots, keyed by NarwhalDevicesPulseGenerator.ndpg_inst_hash. runmanager compiles
+# every shot in the same process, so in a parameter scan that doesn't change the pulse generator outputs, merging, 
+# compressing and encoding the instructions only has to be done for the first shot.
+_compiled_ndpg_inst_cache = OrderedDict()
 
 # This is taken straight from the PrawnBlaster. So who knows if it will work...
 # Define dummy pseudoclock/clockline/intermediatedevice to trick wait monitor
@@ -120,6 +128,34 @@ class NarwhalDevicesPulseGenerator(PseudoclockDevice):
     n_channels = 24
     '''The total number of output channels.'''
 
+    max_instruction_duration = 2**48 - 1
+    '''The longest duration of a single device instruction, in clock cycles.'''
+
+    max_loop_length = 1024
+    '''The longest block of device instructions that compress_ndpg_inst will try to fold into a hardware loop.'''
+
+    instruction_message_length = instruction_message_dtype.itemsize
+    '''The number of bytes in each encoded instruction message, including the message identifier. See ndpulsegen.encode_instruction.'''
+
+    pulse_program_format_version = 1
+    '''Part of ndpg_inst_hash. Increase it whenever a change to merge_ndpg_inst, compress_ndpg_inst or the encoding changes
+    the PULSE_PROGRAM (or PULSE_PROGRAM_ENCODED) compiled from the same outputs, so that BLACS doesn't skip uploading a shot
+    because it has the same hash as one compiled by the old code.'''
+
+    compiled_ndpg_inst_cache_size = 16
+    '''How many compiled instruction tables to keep for reuse by later shots with the same pulse generator outputs. 0 disables the cache.'''
+
+    serial_baudrate = 12E6 #bits per second
+    '''The baudrate of the serial connection to the NDPG (see ndpulsegen.comms). Each byte takes 10 bits to send (8N1).'''
+
+    pulse_program_dtype = [('address', np.int64), ('duration', np.int64), ('goto_address', np.int64), ('goto_counter', np.int64),
+                           ('stop_and_wait', bool), ('hardware_trig_out', bool), ('notify_computer', bool), ('powerline_sync', bool),
+                           ('state', np.uint32), ('state_specified', np.uint32)]
+    '''The numpy dtype of the PULSE_PROGRAM table of device instructions that is saved to the shot file. The output
+    state of all channels is packed into 'state', where bit n is channel n (the same format the NDPG uses). Bit n of 
+    'state_specified' is 0 if channel n was not specified in the labscript experiment, in which case the value set in 
+    the BLACS GUI is used instead.'''
+
     '''May or may not need to rethink which properties go in "connection_table_properties", and which
     do in "device_properties". "device_properties" can only be accessed from the hdf file so are sort of a "per
     shot" type setting. They can be accessed in the "transition_to_buffered" method of the worker, 
@@ -130,6 +166,8 @@ class NarwhalDevicesPulseGenerator(PseudoclockDevice):
     @set_passed_properties(
         property_names={
             "connection_table_properties": [
+                "emulate",
+                "emulator_options"
             ],
             "device_properties": [
                 "clock_limit",
@@ -143,7 +181,8 @@ class NarwhalDevicesPulseGenerator(PseudoclockDevice):
                 "trigger_out_delay",
                 "trigger_on_powerline",
                 "powerline_trigger_delay",
-                "max_instructions"
+                "max_instructions",
+                "record_notifications"
             ],
         }
     )
@@ -157,7 +196,13 @@ class NarwhalDevicesPulseGenerator(PseudoclockDevice):
         trigger_out_delay=0,
         trigger_on_powerline=False,
         powerline_trigger_delay=0,
-        use_wait_monitor=True
+        use_wait_monitor=True,
+        pulse_program_compression='default',
+        pulse_program_chunks=None,
+        compress_instructions='auto',
+        record_notifications=False,
+        emulate=False,
+        emulator_options=None
     ):
         """Narwhal Devices Pulse Generator.
 
@@ -194,6 +239,30 @@ class NarwhalDevicesPulseGenerator(PseudoclockDevice):
                 See also: ndpulsegen.transcode.encode_powerline_trigger_options
             use_wait_monitor (bool, optional): Configure the Pulse Generator to
                 perform its own wait monitoring.
+            pulse_program_compression (str or int or None, optional): The HDF5 compression 
+                filter used for the PULSE_PROGRAM dataset. Defaults to 'default', which uses 
+                the labscript compression setting (gzip). None writes an uncompressed, contiguous 
+                dataset, which is the fastest to write. Any other value is passed to h5py, eg. 
+                'lzf' for fast compression, or an int ∈ [0, 9] for gzip at that level.
+            pulse_program_chunks (bool or tuple or None, optional): The HDF5 chunk shape of the
+                PULSE_PROGRAM dataset, passed to h5py. Defaults to None, where h5py chooses the 
+                chunk shape if the dataset is compressed.
+            compress_instructions (bool or str, optional): Whether to fold repeated blocks of 
+                device instructions into (nested) hardware loops. Defaults to 'auto', where the 
+                instructions are only compressed if there are more than max_instructions of them.
+                True always compresses them, which also reduces upload time. False never does.
+            record_notifications (bool, optional): If True, every notification the NDPG sends 
+                during the shot (address, notify tags, run_time and the host time it was recieved) 
+                is saved to the shot file, in /data/<name>/NOTIFICATIONS. The run_time has 10ns 
+                resolution, so this gives hardware timestamps of any instructions with notify_computer 
+                set, and of waits, the trigger out and the end of the run.
+            emulate (bool, optional): If True, BLACS doesn't connect to a physical NDPG. Instead 
+                it runs the shots on a software emulation of one (see emulator.EmulatedPulseGenerator), 
+                for testing and benchmarking without hardware.
+            emulator_options (dict, optional): Keyword arguments for the emulated NDPG, eg. 
+                {'speed': None} to run as fast as possible rather than in real time, 
+                {'baudrate': 12E6, 'latency': 1E-3} for realistic serial communication, or 
+                {'hardware_trigger_interval': 1E-3} to emulate a hardware trigger every millisecond.
         """
 
 
@@ -203,6 +272,11 @@ class NarwhalDevicesPulseGenerator(PseudoclockDevice):
         # Set the BLACS connections
         self.BLACS_connection = serial_number
 
+        # How the PULSE_PROGRAM is stored in the shot file. Trades off compile time against file size.
+        self.pulse_program_compression = pulse_program_compression
+        self.pulse_program_chunks = pulse_program_chunks
+        self.compress_instructions = compress_instructions
+
         # Wait monitor can only be used if this is the master pseudoclock
         self.use_wait_monitor = use_wait_monitor and self.is_master_pseudoclock
 
@@ -373,7 +447,35 @@ class NarwhalDevicesPulseGenerator(PseudoclockDevice):
         PseudoclockDevice.generate_code(self, hdf5_file)
 
         ndpg_inst = self.pseudo_inst_to_ndpg_inst()
-        self.write_ndpg_inst_to_h5(ndpg_inst, hdf5_file)
+        pulse_program_hash = self.ndpg_inst_hash(ndpg_inst)
+        if pulse_program_hash in _compiled_ndpg_inst_cache:
+            # An earlier shot had exactly the same outputs, so the merged/compressed/encoded instructions will be the same too
+            _compiled_ndpg_inst_cache.move_to_end(pulse_program_hash)
+            ndpg_inst, encoded_ndpg_inst, n_instructions_uncompressed = _compiled_ndpg_inst_cache[pulse_program_hash]
+            ndpg_inst, encoded_ndpg_inst = ndpg_inst.copy(), encoded_ndpg_inst.copy()
+        else:
+            ndpg_inst = self.merge_ndpg_inst(ndpg_inst)
+            n_instructions_uncompressed = len(ndpg_inst)
+            if self.compress_instructions == True or (self.compress_instructions == 'auto' and len(ndpg_inst) > self.max_instructions):
+                ndpg_inst = self.compress_ndpg_inst(ndpg_inst)
+            if len(ndpg_inst) > self.max_instructions:
+                raise LabscriptError(f'{self.name} needs {len(ndpg_inst)} instructions, but the Narwhal Devices Pulse Generator can only store {self.max_instructions}. ' +
+                                     'This is after folding any repeated blocks of instructions into hardware loops' + (', ' if self.compress_instructions else ' (which is disabled with compress_instructions=False), ') +
+                                     'so the experiment needs to be shortened or made more repetitive.')
+            encoded_ndpg_inst = self.encode_ndpg_inst(ndpg_inst)
+            if self.compiled_ndpg_inst_cache_size > 0:
+                _compiled_ndpg_inst_cache[pulse_program_hash] = (ndpg_inst.copy(), encoded_ndpg_inst.copy(), n_instructions_uncompressed)
+                while len(_compiled_ndpg_inst_cache) > self.compiled_ndpg_inst_cache_size:
+                    _compiled_ndpg_inst_cache.popitem(last=False)
+        self.write_ndpg_inst_to_h5(ndpg_inst, hdf5_file, encoded_ndpg_inst)
+        # The BLACS worker uses this to tell if the shot has the same instructions as the last one it uploaded
+        self.set_property('pulse_program_hash', pulse_program_hash, location='device_properties')
+
+        # Save how much of the device this shot uses, so shots that are slow to upload (or close to not fitting) can be found without BLACS
+        for property_name, value in self.ndpg_inst_resources(ndpg_inst).items():
+            self.set_property(property_name, value, location='device_properties')
+        # How many instructions there were before they were folded into hardware loops, so the saving can be seen
+        self.set_property('n_instructions_uncompressed', n_instructions_uncompressed, location='device_properties')
         
         # I might need this in the blacs_workers bit for a couple of reasons:
         # 1. If I am the master, then
@@ -388,196 +490,297 @@ class NarwhalDevicesPulseGenerator(PseudoclockDevice):
         return int(round(object_in_seconds/cycle_period))
 
     def pseudo_inst_to_ndpg_inst(self):
-        ''' I think there are some large errors in here at the moment, but I on't want to deal with them yet. The 
-        instructions that get generated seem to have way more shit in them than they should. but I'll deal with it another time.'''
-
-        dig_outputs = self.direct_outputs.get_all_outputs()
-        # for attr in dir(dig_outputs[0]):
-        #     print('obj.%s = %r'%(attr, getattr(dig_outputs[0], attr)))
+        '''Converts the pseudoclock instructions into a structured array of NDPG device instructions.
 
-        # for attr in dir(self._direct_output_clock_line):
-        #     print('obj.%s = %r'%(attr, getattr(self._direct_output_clock_line, attr)))
+        Rather than walking the pseudoclock instructions one at a time, every column of the table is
+        built at once with numpy. A pseudoclock instruction that only updates direct outputs becomes one
+        device instruction. One that ticks an external clockline becomes two: a rising edge instruction, 
+        and a falling edge instruction that loops back to the rising edge for any repetitions.'''
 
-        print(compiler.wait_table)
-        print(type(compiler.wait_table))
         # the wait table keys are the times in floats. Sort them so we can access them by index.
-        # Note, this will break if 
         wait_table = [compiler.wait_table[key] for key in sorted(compiler.wait_table)]
-
-        print(type(self.pseudoclock.clock))
         assert len(wait_table) == self.pseudoclock.clock.count('WAIT')
-        print('goop')
-        print(wait_table)
-
-        channel_state = np.ones(24, dtype=np.int64)*-1 #-1 indicates that no value has been specified in the labscript experiment, so keep whatever value is set in the blacs GUI.
-        # raw_output_idx = 0
-        raw_output_idx = -1
-        address = 0
-        ndpg_inst = []
-        ACsync = False
-        next_instruction_notify = False
-        wait_idx = 0
-        for instruction in self.pseudoclock.clock:
-            # print('############################################################################################################')
-            # print(instruction)
-            # print()
-
-            if instruction == 'WAIT':                
-                ACsync = wait_table[wait_idx][0].startswith('ACsync')   # this is temproarily saved and reset to False after it is put in an instruction.
-                wait_idx += 1
-                print('ACsync ', ACsync)
-
-                # Change the previous instruction to have a stop_and_wait=True
-                # If this is the first instruction, add it to the start
-                # it it is an ACsync wait, you have to add two instructions. The first instruction of the pulse generator must not be a powerline_sync instruction, as
-                # it will respond the moment it is loaded into memory.
-
-                if len(ndpg_inst) == 0:
-                    if ACsync:
-                        # The first instruction can't be a powerline_sync instruction, so you actually have to add TWO instructions.
-                        ndpg_inst.append({'address':address,
-                                        'duration':1,
-                                        'channel_state':channel_state.copy(),
-                                        'goto_address':0,
-                                        'goto_counter':0,
-                                        'stop_and_wait':True,
-                                        'hardware_trig_out':False,
-                                        'notify_computer':True,
-                                        'powerline_sync':False})
-                        address += 1   
-                        ndpg_inst.append({'address':address,
-                                    'duration':1,
-                                    'channel_state':channel_state.copy(),
-                                    'goto_address':0,
-                                    'goto_counter':0,
-                                    'stop_and_wait':False,
-                                    'hardware_trig_out':False,
-                                    'notify_computer':True,
-                                    'powerline_sync':True})
-                        address += 1  
-                    else:                
-                        ndpg_inst.append({'address':address,
-                                        'duration':1,
-                                        'channel_state':channel_state.copy(),
-                                        'goto_address':0,
-                                        'goto_counter':0,
-                                        'stop_and_wait':True,
-                                        'hardware_trig_out':False,
-                                        'notify_computer':True,
-                                        'powerline_sync':False})
-                        address += 1
-                        next_instruction_notify = True
-                    ACsync = False
-                else:
-                    ndpg_inst[-1]['stop_and_wait'] = True
-                    ndpg_inst[-1]['notify_computer'] = True
-                    next_instruction_notify = True
+
+        # Python is only used to pull the required columns out of the pseudoclock instructions. Everything else is numpy.
+        instructions = [instruction for instruction in self.pseudoclock.clock if instruction != 'WAIT']
+        # For every WAIT, the number of (non-WAIT) pseudoclock instructions that come before it
+        wait_positions = np.array([i - wait_idx for wait_idx, i in enumerate(i for i, instruction in enumerate(self.pseudoclock.clock) if instruction == 'WAIT')], dtype=np.int64)
+        wait_ACsync = np.array([wait[0].startswith('ACsync') for wait in wait_table], dtype=bool)
+        steps = np.array([instruction['step'] for instruction in instructions], dtype=np.float64)
+        reps = np.array([instruction['reps'] for instruction in instructions], dtype=np.int64)
+        direct_output_ticks = np.array([self._direct_output_clock_line in instruction['enabled_clocks'] for instruction in instructions], dtype=bool)
+        clock_line_channels = []
+        clock_line_ticks = []
+        for clock_line in self.pseudoclock.child_devices:
+            if clock_line == self._direct_output_clock_line:
                 continue
+            clock_line_channels.append(self.get_channel_number(clock_line.connection))
+            clock_line_ticks.append([clock_line in instruction['enabled_clocks'] for instruction in instructions])
+        clock_line_ticks = np.array(clock_line_ticks, dtype=bool).reshape(len(clock_line_channels), len(instructions))
+        # We are also using other clocklines to clock external devices, so need a rising and a falling edge instruction
+        external = clock_line_ticks.any(axis=0)
+
+        # If the first pseudoclock instruction is a WAIT, instructions have to be added to the start of the program.
+        # The first instruction of the pulse generator must not be a powerline_sync instruction, as it will respond
+        # the moment it is loaded into memory. So an ACsync wait needs TWO instructions.
+        leading_wait = len(wait_positions) > 0 and wait_positions[0] == 0
+        if leading_wait:
+            n_prefix = 2 if wait_ACsync[0] else 1
+            wait_positions, wait_ACsync = wait_positions[1:], wait_ACsync[1:]
+        else:
+            n_prefix = 0
 
-            # This flag indicates whether we need a full clock tick, or are just updating an internal output
-            only_internal = True
-            for clock_line in instruction['enabled_clocks']:
-                if clock_line == self._direct_output_clock_line: 
-                    # advance i (the index keeping track of internal clockline output)
-                    raw_output_idx += 1
-                else:
-                    # This is the upwards tick of a clock line. 
-                    channel = int(clock_line.connection.split()[1]) #The channel that the clockline is associated with
-                    channel_state[channel] = 1 #upwards tick means it must be 1.
-                    # print(f'raw_output_idx={raw_output_idx}, clock_line.connection={clock_line.connection}')
-
-                    # We are also using other clocklines to clock external devices
-                    only_internal = False
-
-            # Set the output state for each channel specified
-            for output in dig_outputs:
-                channel = int(output.connection.split()[1])
-                channel_state[channel] = output.raw_output[raw_output_idx]
-
-
-            if only_internal:
-                print('only internal address:', address)
-                # We only need to update a direct output, so no need to tick the clocks.
-                duration = int(np.round((instruction['step']/self.clock_resolution)))
-                ndpg_inst.append({'address':address,
-                                'duration':duration,
-                                'channel_state':channel_state.copy(),
-                                'goto_address':0,
-                                'goto_counter':0,
-                                'stop_and_wait':False,
-                                'hardware_trig_out':False,
-                                'notify_computer':next_instruction_notify,
-                                'powerline_sync':ACsync})
-                ACsync = False
-                next_instruction_notify = False
-                # raw_output_idx += 1
-                address +=1   
-            else:
-                print('external:', address)
-                # We are also using other clocklines to clock external devices
-                if self.pulse_width == 'symmetric':
-                    high_time = instruction['step']/2
-                else:
-                    high_time = self.pulse_width
-                low_time = instruction['step'] - high_time
-
-                # create the rising edge instruction
-                duration = int(np.round((high_time/self.clock_resolution)))
-                ndpg_inst.append({'address':address,
-                                'duration':duration,
-                                'channel_state':channel_state.copy(),
-                                'goto_address':0,
-                                'goto_counter':0,
-                                'stop_and_wait':False,
-                                'hardware_trig_out':False,
-                                'notify_computer':next_instruction_notify,
-                                'powerline_sync':ACsync})
-                ACsync = False
-                next_instruction_notify = False
-                loop_start_address = address
-                address += 1
-
-                # For all clocklines that this seudo-psudoclock instruction relates to, get
-                #its channel, and set it to 0, since this is were it transitions to low.
-                for clock_line in instruction['enabled_clocks']:
-                    if clock_line != self._direct_output_clock_line: #ignore the direct outputs, you have already set those states
-                        channel = int(clock_line.connection.split()[1]) #The channel that the clockline is associated with
-                        channel_state[channel] = 0
-                
-                # goto_counter on NDPG operates slightly differently to instruction['reps']
-                if instruction['reps'] == 0:
-                    goto_counter = 0
-                else:
-                    goto_counter = instruction['reps'] - 1
-                duration = int(np.round((low_time/self.clock_resolution)))
-                ndpg_inst.append({'address':address,
-                                'duration':duration,
-                                'channel_state':channel_state.copy(),
-                                'goto_address':loop_start_address,
-                                'goto_counter':goto_counter,
-                                'stop_and_wait':False,
-                                'hardware_trig_out':False,
-                                'notify_computer':False,
-                                'powerline_sync':False})
-                address += 1
+        # Index of the (first) device instruction generated by each pseudoclock instruction
+        n_device_inst = 1 + external.astype(np.int64)
+        rising = n_prefix + np.cumsum(n_device_inst) - n_device_inst
+        falling = rising[external] + 1
+        n_inst = n_prefix + int(n_device_inst.sum())
+
+        ndpg_inst = np.zeros(n_inst, dtype=self.pulse_program_dtype)
+        ndpg_inst['address'] = np.arange(n_inst)
+
+        # Durations
+        if self.pulse_width == 'symmetric':
+            high_time = steps/2
+        else:
+            high_time = np.full_like(steps, self.pulse_width)
+        low_time = steps - high_time
+        ndpg_inst['duration'][:n_prefix] = 1
+        ndpg_inst['duration'][rising] = np.where(external, np.round(high_time/self.clock_resolution), np.round(steps/self.clock_resolution))
+        ndpg_inst['duration'][falling] = np.round(low_time[external]/self.clock_resolution)
+
+        # The falling edge loops back to the rising edge. goto_counter on NDPG operates slightly differently to instruction['reps']
+        ndpg_inst['goto_address'][falling] = rising[external]
+        ndpg_inst['goto_counter'][falling] = np.where(reps == 0, 0, reps - 1)[external]
+
+        # Channel states are packed straight into the state words. A channel that is not specified in the labscript 
+        # experiment is left out of state_specified, so it keeps whatever value is set in the blacs GUI.
+        state = ndpg_inst['state']
+        state_specified = ndpg_inst['state_specified']
+        # A clockline channel is 1 on its rising edge, and 0 from then on, including the falling edge instruction.
+        for channel, ticks in zip(clock_line_channels, clock_line_ticks):
+            bit = np.uint32(1 << channel)
+            ticked = np.logical_or.accumulate(ticks)
+            state[rising] |= ticks*bit
+            state_specified[rising] |= ticked*bit
+            state_specified[falling] |= ticked[external]*bit
+        # The direct outputs only have a value in raw_output for the instructions where their clockline ticks.
+        raw_output_idx = np.cumsum(direct_output_ticks) - 1
+        for output in self.get_direct_outputs():
+            bit = np.uint32(1 << self.get_channel_number(output.connection))
+            output_state = (np.asarray(output.raw_output)[raw_output_idx] != 0)*bit
+            state[rising] |= output_state
+            state[falling] |= output_state[external]
+            state_specified[rising] |= bit
+            state_specified[falling] |= bit
+
+        # Waits
+        if leading_wait:
+            ndpg_inst['stop_and_wait'][0] = True
+            ndpg_inst['notify_computer'][:n_prefix] = True
+            if n_prefix == 2:
+                ndpg_inst['powerline_sync'][1] = True
+            elif len(instructions):
+                ndpg_inst['notify_computer'][n_prefix] = True
+        # Change the instruction before each wait to have a stop_and_wait=True, and notify on both sides of the wait
+        before_wait = rising[wait_positions - 1] + external[wait_positions - 1]
+        after_wait = rising[wait_positions]
+        ndpg_inst['stop_and_wait'][before_wait] = True
+        ndpg_inst['notify_computer'][before_wait] = True
+        ndpg_inst['notify_computer'][after_wait] = True
+        ndpg_inst['powerline_sync'][after_wait[wait_ACsync]] = True
 
         return ndpg_inst
 
 
-    def write_ndpg_inst_to_h5(self, ndpg_inst, hdf5_file):
-        # OK now we squeeze the instructions into a numpy array ready for writing to hdf5:
-        inst_table_dtype = [('address', np.int64), ('duration', np.int64), ('goto_address', np.int64), ('goto_counter', np.int64),
-                     ('stop_and_wait', bool), ('hardware_trig_out', bool), ('notify_computer', bool), ('powerline_sync', bool),
-                     ('channel_state', np.int8, (24))]
-        inst_table = np.empty(len(ndpg_inst),dtype = inst_table_dtype)
-        for i, inst in enumerate(ndpg_inst):
-            inst_table[i] = (inst['address'], inst['duration'], inst['goto_address'], inst['goto_counter'], 
-                          inst['stop_and_wait'], inst['hardware_trig_out'], inst['notify_computer'], inst['powerline_sync'], inst['channel_state'])
+    def ndpg_inst_hash(self, ndpg_inst):
+        '''A hash of the (unmerged) device instructions, every setting that changes how they are merged and compressed,
+        and pulse_program_format_version. The unmerged instructions are a cheap, exact function of the pseudoclock 
+        instructions and the direct output values, so two shots with the same hash end up with the same PULSE_PROGRAM.'''
+        settings = (self.pulse_program_format_version, self.compress_instructions, self.max_instructions, self.max_loop_length, self.max_instruction_duration)
+        pulse_program_hash = hashlib.sha256(repr(settings).encode())
+        pulse_program_hash.update(repr(ndpg_inst.dtype.descr).encode())
+        pulse_program_hash.update(np.ascontiguousarray(ndpg_inst).tobytes())
+        return pulse_program_hash.hexdigest()
+
+    def merge_ndpg_inst(self, ndpg_inst):
+        '''Merges consecutive device instructions with the same output state into a single, longer instruction.
+
+        The pseudoclock has an instruction at every change time, even when none of the NDPG channels change (eg. the
+        change is on another clockline, or on a device sharing the pseudoclock). An instruction can be merged with 
+        the next one as long as it doesn't stop_and_wait or loop, and the next one doesn't notify, powerline_sync, 
+        output a hardware trigger, loop, or get jumped to by a loop. The merged instruction keeps the flags of the 
+        first instruction, and the stop_and_wait of the last, so waits and notifications happen at the same times.'''
+        looping = ndpg_inst['goto_counter'] > 0
+        goto_target = np.zeros(len(ndpg_inst), dtype=bool)
+        goto_target[ndpg_inst['goto_address'][looping]] = True
+        # Whether each instruction can be merged with the next one
+        mergeable = ((ndpg_inst['state'][:-1] == ndpg_inst['state'][1:]) 
+                     & (ndpg_inst['state_specified'][:-1] == ndpg_inst['state_specified'][1:])
+                     & ~ndpg_inst['stop_and_wait'][:-1] & ~looping[:-1] & ~looping[1:] & ~goto_target[1:]
+                     & ~ndpg_inst['notify_computer'][1:] & ~ndpg_inst['powerline_sync'][1:] & ~ndpg_inst['hardware_trig_out'][1:])
+        if not mergeable.any():
+            return ndpg_inst
+
+        # The first instruction of each group of merged instructions is kept
+        keep = np.concatenate(([True], ~mergeable))
+        group_starts = np.flatnonzero(keep)
+        durations = np.add.reduceat(ndpg_inst['duration'], group_starts)
+        if np.any(durations > self.max_instruction_duration):
+            # Rare, so it is fine to do this in python. Start a new group whenever the duration would be too long.
+            group_duration = 0
+            for i, duration in enumerate(ndpg_inst['duration']):
+                if not keep[i] and group_duration + duration > self.max_instruction_duration:
+                    keep[i] = True
+                group_duration = duration if keep[i] else group_duration + duration
+            group_starts = np.flatnonzero(keep)
+            durations = np.add.reduceat(ndpg_inst['duration'], group_starts)
+        group_ends = np.concatenate((group_starts[1:], [len(ndpg_inst)])) - 1
+
+        # Renumber the instructions that are left. Only the first instruction of a group can be jumped to.
+        new_address = np.cumsum(keep) - 1
+        merged = ndpg_inst[keep]
+        merged['duration'] = durations
+        merged['stop_and_wait'] = ndpg_inst['stop_and_wait'][group_ends]
+        merged['goto_address'] = np.where(merged['goto_counter'] > 0, new_address[merged['goto_address']], 0)
+        merged['address'] = np.arange(len(merged))
+        return merged
+
+    def compress_ndpg_inst(self, ndpg_inst):
+        '''Folds repeated blocks of device instructions into hardware loops, so long but repetitive sequences fit in
+        the Pulse Generator memory.
+
+        A block of instructions that is immediately repeated is replaced by a single copy, where the last instruction
+        of the block jumps back to the first with goto_counter set to the number of extra repetitions. Each pass 
+        looks for repeated blocks up to max_loop_length instructions long, and is run until nothing more can be 
+        folded. Blocks found in later passes can contain the loops made by earlier passes, so the loops nest.
+
+        Instructions that stop_and_wait, notify the computer, or powerline_sync are never folded, since the wait monitor
+        relies on their addresses. The last instruction of a block must not already be the end of a loop, because an 
+        instruction only has one goto_address. The timing of the outputs is unchanged.'''
+        while True:
+            n = len(ndpg_inst)
+            looping = ndpg_inst['goto_counter'] > 0
+            # Instructions are identical if they are the same, apart from their address. A goto_address is compared 
+            # relative to the instruction address, so that each copy of a loop compares equal.
+            relative_goto = np.where(looping, ndpg_inst['goto_address'] - ndpg_inst['address'], 0)
+            flagged = ndpg_inst['stop_and_wait'] | ndpg_inst['notify_computer'] | ndpg_inst['powerline_sync']
+            columns = np.stack([ndpg_inst['duration'], relative_goto, ndpg_inst['goto_counter'], ndpg_inst['hardware_trig_out'], 
+                                flagged, ndpg_inst['state'], ndpg_inst['state_specified']], axis=1).astype(np.int64)
+            _, inst_ids = np.unique(columns, axis=0, return_inverse=True)
+            inst_ids = inst_ids.reshape(n)
+            flagged_count = np.concatenate(([0], np.cumsum(flagged)))
+            # Every goto, sorted by the address it jumps to.
+            goto_sources = np.flatnonzero(looping)
+            goto_targets = ndpg_inst['goto_address'][goto_sources]
+            order = np.argsort(goto_targets, kind='stable')
+            goto_sources, goto_targets = goto_sources[order], goto_targets[order]
+
+            def can_fold(start, length, copies):
+                end = start + length*copies
+                block_end = start + length - 1
+                if flagged_count[end] != flagged_count[start] or looping[block_end]:
+                    return False
+                # Gotos in the block must stay in the block, and nothing else can jump into the block (except to its start).
+                first, last = np.searchsorted(goto_targets, [start, end])
+                if np.any(goto_sources[first:last] >= end) or np.any((goto_sources[first:last] < start) & (goto_targets[first:last] != start)):
+                    return False
+                block_gotos = ndpg_inst['goto_address'][start:block_end+1][looping[start:block_end+1]]
+                return not np.any(block_gotos < start)
+
+            # Find every run where the instructions repeat with a period of length, and the number of whole copies of the block.
+            candidates = []
+            for length in range(1, min(self.max_loop_length, n//2) + 1):
+                repeats = np.concatenate(([False], inst_ids[length:] == inst_ids[:-length], [False]))
+                run_starts = np.flatnonzero(repeats[1:] & ~repeats[:-1])
+                run_ends = np.flatnonzero(~repeats[1:] & repeats[:-1])
+                run_lengths = run_ends - run_starts
+                long_enough = run_lengths >= length
+                for run_start, run_length in zip(run_starts[long_enough], run_lengths[long_enough]):
+                    # The block can start anywhere in the first period of the run.
+                    for offset in range(length):
+                        copies = (run_length - offset)//length + 1
+                        if copies < 2:
+                            break
+                        if can_fold(run_start + offset, length, copies):
+                            candidates.append(((copies - 1)*length, run_start + offset, length, copies))
+                            break
+            if not candidates:
+                break
+
+            # Fold the blocks that save the most instructions first, as long as they don't overlap a block already folded.
+            candidates.sort(key=lambda candidate: -candidate[0])
+            keep = np.ones(n, dtype=bool)
+            folded = np.zeros(n, dtype=bool)
+            goto_address = ndpg_inst['goto_address'].copy()
+            goto_counter = ndpg_inst['goto_counter'].copy()
+            for _, start, length, copies in candidates:
+                end = start + length*copies
+                if folded[start:end].any():
+                    continue
+                folded[start:end] = True
+                keep[start+length:end] = False
+                goto_address[start+length-1] = start
+                goto_counter[start+length-1] = copies - 1
+
+            # Renumber the instructions that are left
+            new_address = np.cumsum(keep) - 1
+            ndpg_inst['goto_address'] = np.where(goto_counter > 0, new_address[goto_address], 0)
+            ndpg_inst['goto_counter'] = goto_counter
+            ndpg_inst = ndpg_inst[keep]
+            ndpg_inst['address'] = np.arange(len(ndpg_inst))
+
+            if self.compress_instructions == 'auto' and len(ndpg_inst) <= self.max_instructions:
+                break
 
+        return ndpg_inst
+
+    def ndpg_inst_resources(self, ndpg_inst):
+        '''Summarises the resources the device instructions need: how many instructions and bytes are uploaded (and
+        roughly how long that takes over the serial connection), how many waits and notifications there are, and
+        how deeply the hardware loops are nested.'''
+        # Every instruction with a nonzero goto_counter loops back over the block [goto_address, address]. The loop depth
+        # of an instruction is the number of these blocks it is inside.
+        loops = ndpg_inst[ndpg_inst['goto_counter'] > 0]
+        depth_changes = np.zeros(len(ndpg_inst) + 1, dtype=np.int64)
+        np.add.at(depth_changes, loops['goto_address'], 1)
+        np.add.at(depth_changes, loops['address'] + 1, -1)
+        upload_bytes = len(ndpg_inst)*self.instruction_message_length
+        return {
+            'n_instructions': len(ndpg_inst),
+            'upload_bytes': upload_bytes,
+            'estimated_upload_time': upload_bytes*10/self.serial_baudrate,
+            'n_waits': int(ndpg_inst['stop_and_wait'].sum()),
+            'n_notify_instructions': int(ndpg_inst['notify_computer'].sum()),
+            'n_hardware_loops': len(loops),
+            'max_loop_depth': int(np.cumsum(depth_changes).max()),
+        }
 
-        # Okay now write it to the file: 
+    def encode_ndpg_inst(self, ndpg_inst):
+        '''Encodes the device instructions into the messages that are uploaded to the NDPG, so the BLACS worker doesn't 
+        have to do it between shots. Returns a (len(ndpg_inst), instruction_message_length) uint8 array. Unspecified
+        channels are encoded as low, and are replaced with the BLACS GUI values by the worker, which overwrites the 'state' bytes of each message (see transcode.instruction_message_dtype).'''
+        unspecified_low = ndpg_inst.copy()
+        unspecified_low['state'] &= unspecified_low['state_specified']
+        try:
+            return encode_instructions(unspecified_low)
+        except ValueError as ex:
+            raise LabscriptError(f'{self.name} could not encode its device instructions: {ex}')
+
+    def write_ndpg_inst_to_h5(self, ndpg_inst, hdf5_file, encoded_ndpg_inst=None):
+        # ndpg_inst is already a structured array in the PULSE_PROGRAM layout, so it is written to the file in one go.
+        compression = config.compression if self.pulse_program_compression == 'default' else self.pulse_program_compression
         group = hdf5_file['/devices/'+self.name]  
-        group.create_dataset('PULSE_PROGRAM', compression=config.compression,data = inst_table)   
+        group.create_dataset('PULSE_PROGRAM', data=ndpg_inst, compression=compression, chunks=self.pulse_program_chunks)   
+        # The same instructions, already encoded, so that the worker only has to fill in the unspecified channels and upload them.
+        encoded_chunks = self.pulse_program_chunks
+        if isinstance(encoded_chunks, tuple):
+            encoded_chunks = encoded_chunks + (self.instruction_message_length,)
+        if encoded_ndpg_inst is None:
+            encoded_ndpg_inst = self.encode_ndpg_inst(ndpg_inst)
+        group.create_dataset('PULSE_PROGRAM_ENCODED', data=encoded_ndpg_inst, compression=compression, chunks=encoded_chunks)
+        # Where each wait starts and ends, for the internal wait monitor in the BLACS worker
+        group.create_dataset('WAIT_ADDRESSES', data=find_wait_addresses(ndpg_inst))
         self.set_property('stop_time', self.stop_time, location='device_properties')
 
 
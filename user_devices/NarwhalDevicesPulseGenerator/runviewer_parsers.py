@@ -11,6 +11,8 @@
 #                                                                   #
 #####################################################################
 
+import warnings
+
 import labscript_utils.h5_lock  # noqa: F401
 import h5py
 import numpy as np
@@ -18,6 +20,286 @@ import numpy as np
 import labscript_utils.properties as properties
 
 
+def find_loops(pulse_program):
+    '''Finds the hardware loops in the pulse_program. Each instruction with a nonzero goto_counter is the end of a loop, 
+    and the block of instructions [goto_address, address] is executed goto_counter + 1 times, after which the loop 
+    counter resets (so a loop nested in another runs all of its repetitions for each repetition of the outer loop).
+
+    Returns (starts, ends, goto_counters, children), where the loops are sorted by start address (outer loops first), and
+    children[loop] is the list of loops directly inside loop (children[-1] are the outermost loops). Returns None if the
+    loops don't nest (a goto that jumps forwards, or into the middle of another loop), which the compiler never makes.'''
+    ends = np.flatnonzero(pulse_program['goto_counter'] > 0)
+    starts = pulse_program['goto_address'][ends].astype(np.int64)
+    if np.any(starts > ends):
+        return None
+    order = np.lexsort((-ends, starts))
+    starts, ends = starts[order], ends[order]
+    goto_counters = pulse_program['goto_counter'][ends].astype(np.int64)
+    children = {-1: []}
+    enclosing = [-1]    # Stack of the loops that contain the current one
+    for loop, (start, end) in enumerate(zip(starts.tolist(), ends.tolist())):
+        while enclosing[-1] != -1 and ends[enclosing[-1]] < start:
+            enclosing.pop()
+        if enclosing[-1] != -1 and ends[enclosing[-1]] < end:
+            return None
+        children[enclosing[-1]].append(loop)
+        children[loop] = []
+        enclosing.append(loop)
+    return starts, ends, goto_counters, children
+
+
+def walk_addresses(pulse_program):
+    '''The address of every instruction executed, in order, found by stepping through the pulse_program one instruction 
+    at a time like the Pulse Generator does. Only used for programs where the loops don't nest (see find_loops).'''
+    # It is assumed that the final ram address is the last address in the list (of sorted dictionary instructions)
+    final_address = len(pulse_program)-1
+    goto_counters = pulse_program['goto_counter'].copy()
+    addresses = []
+    address = 0
+    while True:
+        addresses.append(address)
+        if goto_counters[address] == 0:
+            goto_counters[address] = pulse_program['goto_counter'][address]
+            if address == final_address:
+                break
+            address += 1
+        else:
+            goto_counters[address] -= 1
+            address = pulse_program['goto_address'][address]
+    return np.array(addresses, dtype=np.int32)
+
+
+class PulseProgramTree(object):
+    '''The hardware loop structure of a PULSE_PROGRAM, so that the edges of a channel (and the times instructions are
+    executed) can be found by tiling one repetition of each loop, rather than stepping through every executed instruction.
+
+    Each loop (and the whole program, which is node -1) is a node. A node holds its items (the instructions in it, and the
+    loops directly inside it) in order, with their start times (in clock cycles) relative to the start of the node. A
+    loop item lasts as long as all repetitions of its node.'''
+
+    def __init__(self, pulse_program):
+        self.pulse_program = pulse_program
+        loops = find_loops(pulse_program)
+        # The row of the PULSE_PROGRAM of each instruction the nodes are built from
+        self.rows = np.arange(len(pulse_program))
+        if loops is None:
+            # The loops don't nest, so expand them. The program then has no loops, so nothing else needs to change.
+            self.rows = walk_addresses(pulse_program)
+            pulse_program = np.zeros(len(self.rows), dtype=pulse_program.dtype)
+            pulse_program['duration'] = self.pulse_program['duration'][self.rows]
+            pulse_program['state'] = self.pulse_program['state'][self.rows]
+            loops = find_loops(pulse_program)
+        starts, ends, goto_counters, children = loops
+        self.nodes = {}
+        # Loops inside another loop come after it, so build them in reverse to build every loop before the loop it is in
+        for loop in list(range(len(starts)))[::-1] + [-1]:
+            if loop == -1:
+                first, last, repetitions = 0, len(pulse_program) - 1, 1
+            else:
+                first, last, repetitions = starts[loop], ends[loop], goto_counters[loop] + 1
+            kinds, rows, durations, states = [], [], [], []
+            address = first
+            for child in children[loop] + [None]:
+                plain = np.arange(address, last + 1 if child is None else starts[child])
+                kinds.append(np.full(len(plain), -1))
+                rows.append(plain)
+                durations.append(pulse_program['duration'][plain].astype(np.int64))
+                states.append(pulse_program['state'][plain].astype(np.uint32))
+                if child is not None:
+                    kinds.append([child])
+                    rows.append([-1])
+                    durations.append([self.nodes[child]['period']*self.nodes[child]['repetitions']])
+                    states.append(np.zeros(1, dtype=np.uint32))
+                    address = ends[child] + 1
+            kinds, rows, durations, states = np.concatenate(kinds).astype(np.int64), np.concatenate(rows).astype(np.int64), np.concatenate(durations).astype(np.int64), np.concatenate(states)
+            self.nodes[loop] = {
+                'kinds': kinds,
+                'rows': rows,
+                'states': states,
+                'offsets': np.concatenate(([0], np.cumsum(durations)[:-1])),
+                'ends': np.cumsum(durations),
+                'period': int(durations.sum()),
+                'repetitions': int(repetitions),
+            }
+        self.end_time = self.nodes[-1]['period']
+
+    def execution_times(self, row_mask):
+        '''The start times (in clock cycles) of every execution of the instructions selected by row_mask (a bool for each 
+        row of the PULSE_PROGRAM), in time order, and the row of the PULSE_PROGRAM executed at each of them. Found from the 
+        loop structure, by tiling the times in one repetition of each loop, so the work depends on how many times there 
+        are, not how many instructions are executed.'''
+        # The nodes are built from self.rows, so look up the mask (and the rows) through it
+        row_mask = np.asarray(row_mask, dtype=bool)[self.rows]
+
+        def pass_times(node_id):
+            # The times (relative to the start of the node) and rows in one repetition of the node
+            node = self.nodes[node_id]
+            plain = node['kinds'] == -1
+            selected = plain.copy()
+            selected[plain] = row_mask[node['rows'][plain]]
+            times, rows = [node['offsets'][selected]], [node['rows'][selected]]
+            for item in np.flatnonzero(~plain).tolist():
+                child = self.nodes[node['kinds'][item]]
+                child_times, child_rows = pass_times(node['kinds'][item])
+                if len(child_times):
+                    repetition_starts = node['offsets'][item] + child['period']*np.arange(child['repetitions'], dtype=np.int64)
+                    times.append((repetition_starts[:, np.newaxis] + child_times[np.newaxis, :]).ravel())
+                    rows.append(np.tile(child_rows, child['repetitions']))
+            times, rows = np.concatenate(times), np.concatenate(rows)
+            order = np.argsort(times, kind='stable')
+            return times[order], rows[order]
+
+        times, rows = pass_times(-1)
+        return times, self.rows[rows]
+
+    def edges(self, channel):
+        '''The times (in clock cycles) at which channel changes, and the values it changes to (starting with its value at
+        time 0), the same as stepping through every executed instruction (see test_runviewer_parsers), but found from the 
+        loop structure. The edges in one
+        repetition of each loop are found once (for each value the channel has when the loop starts) and tiled, so the 
+        work depends on how many edges there are, not how many instructions are executed.'''
+        bits = {}
+        passes = {}
+
+        def first_bit(node_id):
+            # The value of the channel at the start of a node
+            node = self.nodes[node_id]
+            kind = node['kinds'][0]
+            return int((node['states'][0] >> channel) & 1) if kind == -1 else first_bit(kind)
+
+        def last_bit(node_id):
+            # The value of the channel at the end of a node (which doesn't depend on the value it started with)
+            if node_id not in bits:
+                node = self.nodes[node_id]
+                kind = node['kinds'][-1]
+                bits[node_id] = int((node['states'][-1] >> channel) & 1) if kind == -1 else last_bit(kind)
+            return bits[node_id]
+
+        def pass_edges(node_id, value):
+            # The edges in one repetition of the node (relative to its start), when the channel is value as it starts
+            key = (node_id, value)
+            if key in passes:
+                return passes[key]
+            node = self.nodes[node_id]
+            plain = node['kinds'] == -1
+            times, values = [], []
+            loop_items = np.flatnonzero(~plain).tolist()
+            run_start = 0
+            for item in loop_items + [len(plain)]:
+                # The instructions between the loops, all at once
+                run_values = ((node['states'][run_start:item] >> channel) & 1).astype(np.int8)
+                changed = np.flatnonzero(run_values != np.concatenate(([value], run_values[:-1])))
+                times.append(node['offsets'][run_start:item][changed])
+                values.append(run_values[changed])
+                if len(run_values):
+                    value = int(run_values[-1])
+                if item == len(plain):
+                    break
+                child_id = node['kinds'][item]
+                child = self.nodes[child_id]
+                # The first repetition starts with the value before the loop, and the rest start with the value at the end of the loop
+                first_times, first_values = pass_edges(child_id, value)
+                times.append(node['offsets'][item] + first_times)
+                values.append(first_values)
+                if child['repetitions'] > 1:
+                    repeat_times, repeat_values = pass_edges(child_id, last_bit(child_id))
+                    repetition_starts = node['offsets'][item] + child['period']*np.arange(1, child['repetitions'], dtype=np.int64)
+                    times.append((repetition_starts[:, np.newaxis] + repeat_times[np.newaxis, :]).ravel())
+                    values.append(np.tile(repeat_values, child['repetitions'] - 1))
+                value = last_bit(child_id)
+                run_start = item + 1
+            passes[key] = (np.concatenate(times).astype(np.int64), np.concatenate(values).astype(np.int8))
+            return passes[key]
+
+        value = first_bit(-1)
+        times, values = pass_edges(-1, value)
+        return np.concatenate(([0], times)), np.concatenate(([value], values)).astype(np.int8)
+
+class SegmentTiming(object):
+    '''Maps times in the pulse program (clock cycles from the start of the program, not counting the time spent waiting)
+    to times in the shot (seconds), and back.
+
+    The program is split into segments by the stop_and_wait instructions. The first segment starts at start_time. Each
+    segment after that starts when the wait before it is ended. When the Pulse Generator is triggered by another device, 
+    that is the first rising edge of trigger_times at or after the wait started, plus trigger_delay (a rising edge while 
+    the Pulse Generator is running doesn't do anything). If the wait is never ended, the program stops there.'''
+
+    def __init__(self, wait_ends, end_time, clock_resolution, trigger_times=None, trigger_delay=0, wait_delay=0):
+        self.clock_resolution = clock_resolution
+        # Program time of the start and end of each segment
+        self.segment_starts = np.concatenate(([0], wait_ends)).astype(np.int64)
+        self.segment_ends = np.append(wait_ends, end_time).astype(np.int64)
+        segment_lengths = (self.segment_ends - self.segment_starts)*clock_resolution
+        if trigger_times is None:
+            # Started by software, and no waits are ended by triggers. Assume they end straight away.
+            self.starts = np.concatenate(([0], np.cumsum(segment_lengths[:-1] + wait_delay)))
+        else:
+            # Each segment depends on when the one before ended, so this has to go one wait at a time (but only one searchsorted each)
+            starts = []
+            wait_start = -np.inf
+            for segment_length in segment_lengths.tolist():
+                trigger_index = np.searchsorted(trigger_times, wait_start, side='left')
+                if trigger_index == len(trigger_times):
+                    if starts:
+                        warnings.warn(f'No trigger ends wait {len(starts) - 1}, so the rest of the program is not run.')
+                    break
+                starts.append(trigger_times[trigger_index] + trigger_delay)
+                wait_start = starts[-1] + segment_length + wait_delay
+            if not starts:
+                warnings.warn('The Pulse Generator is never triggered. Showing it as if it was started at the start of the shot.')
+                starts = np.concatenate(([0], np.cumsum(segment_lengths[:-1] + wait_delay)))
+            self.starts = np.array(starts)
+        # Segments that are never run are dropped, so the program ends early
+        self.segment_starts, self.segment_ends = self.segment_starts[:len(self.starts)], self.segment_ends[:len(self.starts)]
+        self.end_time = int(self.segment_ends[-1]) if len(self.starts) else 0
+
+    def shot_times(self, program_times):
+        '''Program times (clock cycles) to shot times (seconds).'''
+        segment = np.clip(np.searchsorted(self.segment_ends, program_times, side='right'), 0, len(self.starts) - 1)
+        # An instruction at the very end of a segment starts the next one
+        return self.starts[segment] + (program_times - self.segment_starts[segment])*self.clock_resolution
+
+    def program_times(self, shot_times):
+        '''Shot times (seconds) to program times (clock cycles). Times while waiting are the end of the wait.'''
+        segment = np.clip(np.searchsorted(self.starts, shot_times, side='right') - 1, 0, len(self.starts) - 1)
+        program_times = self.segment_starts[segment] + (np.asarray(shot_times) - self.starts[segment])/self.clock_resolution
+        return np.clip(program_times, self.segment_starts[segment], self.segment_ends[segment])
+
+
+class NarwhalDevicesPulseGeneratorTrace(object):
+    '''The trace of one channel of the Pulse Generator, which is only generated when it is needed.
+
+    It can be used as the (times, values) tuple that runviewer expects, which has every time the channel changes, found 
+    from the loop structure (see PulseProgramTree.edges) without expanding the whole program. The trace is exact, so its
+    memory grows with the number of edges in the shot.'''
+
+    def __init__(self, program, channel, timing):
+        self.program = program
+        self.channel = channel
+        self.timing = timing
+        self._edges = None
+
+    def edges(self):
+        '''Every time the channel changes during the shot (in seconds), and the values it changes to.'''
+        if self._edges is None:
+            edge_times, edge_values = self.program.edges(self.channel)
+            run = edge_times < self.timing.end_time
+            edge_times, edge_values = edge_times[run], edge_values[run]
+            # At every "times" entry, the plot goes to the level indicated in the "states" array, and then stays there until the next entry,
+            # so add an entry at the end of the run to draw the last level until then
+            self._edges = (self.timing.shot_times(np.append(edge_times, self.timing.end_time)), np.append(edge_values, edge_values[-1]))
+        return self._edges
+
+    def __len__(self):
+        return 2
+
+    def __getitem__(self, index):
+        return self.edges()[index]
+
+    def __iter__(self):
+        return iter(self.edges())
+
+
 class NarwhalDevicesPulseGeneratorParser(object):
     """Runviewer parser for the PrawnBlaster Pseudoclocks."""
     def __init__(self, path, device):
@@ -56,8 +338,7 @@ class NarwhalDevicesPulseGeneratorParser(object):
         print(f'clock variable: {clock}')
         print()
 
-        # If not the master pseudoclock, then I need to handle the case of getting
-        # possibly multiple triggers. Ignore for now though.
+        # If not the master pseudoclock, the run is started (and waits are ended) by rising edges of the clock. See SegmentTiming.
 
         # get the instructions
         with h5py.File(self.path, "r") as file:
@@ -80,79 +361,24 @@ class NarwhalDevicesPulseGeneratorParser(object):
 
         # [print(x) for x in instructions]
 
-        # It is assumed that the final ram address is the last address in the list (of sorted dictionary instructions)
-        final_address = len(instructions)-1
-        channel_states = []
-        durations = []
-        stop_and_wait = []
-        powerline_sync = []
-        # addresses = []
-        # instruction_address = []
-        # goto_counter = []
-        # goto_counter_original = []
-        # hard_trig_out = []
-        # notify_computer = []
-
-
-        instructions_goto_counter_original = instructions['goto_counter'].copy()
-        address = 0
-        while True:
-            instruction = instructions[:][address]
-            # Save all the required infor from this instruction
-
-            channel_states.append(instruction['channel_state'])
-            durations.append(instruction['duration'])
-            stop_and_wait.append(instruction['stop_and_wait'])
-            powerline_sync.append(instruction['powerline_sync'])
-
-            # instruction_address.append(address)
-            # goto_counter.append(instruction['goto_counter'])
-            # goto_counter_original.append(instructions_goto_counter_original[address])
-            # hard_trig_out.append(instruction['hardware_trig_out'])
-            # notify_computer.append(instruction['notify_computer'])
-
-            if instruction['goto_counter'] == 0:
-                instruction['goto_counter'] = instructions_goto_counter_original[address]
-                if address == final_address:
-                    break
-                address += 1
-            else:
-                instruction['goto_counter'] -= 1
-                address = instruction['goto_address']
+        # The loop structure of the program. The traces are generated from it when they are needed.
+        program = PulseProgramTree(instructions)
+
+        # Each wait ends at the end of an execution of a stop_and_wait instruction
+        wait_starts, wait_rows = program.execution_times(instructions['stop_and_wait'])
+        wait_ends = wait_starts + instructions['duration'][wait_rows].astype(np.int64)
 
+        trigger_times = None
         if clock is not None:
-            # Compute the times of the clock rising edges
-            clock_times, clock_value = clock[0], clock[1]
-            differences = np.diff(clock_value, prepend=0)  # Prepend 0 to ensure the first state is evaluated correctly
-            rising_edges = np.where(differences == 1)[0]  # Get indices where a rising edge occurs
-            rising_edge_times = clock_times[rising_edges]
-            print("I need to deal with this, like I have to add the clock delay or something")
-            print("there should be one rising edge for the initial start, plus one for every wait")
-            print("actually, there could be lots, but al are ignored unless they are at the start or during a wait")
-            raise Exception("need to do this")
-
-
-        # "times" start at zero, so prepending a 0 duration element makes things plot correctly
-        durations.insert(0, 0)
-        # At every "times" entry, the plot goes to the level indicated in the "states" array, and then stays there until the next entry
-        # Need to add entries so they are the same length as "times"
-        channel_states.append(channel_states[-1])
-        stop_and_wait.append(False)
-        powerline_sync.append(False)
-
-        channel_states = np.array(channel_states)
-        durations = np.array(durations) * self.clock_resolution
-        stop_and_wait = np.array(stop_and_wait)
-        powerline_sync = np.array(powerline_sync)
-
-        times = np.cumsum(durations)
-
-        # print(durations)
-        # print(times)
-        # print(channel_states)
-        # print(channel_states.shape)
-        # print(stop_and_wait)
-        # print(powerline_sync)
+            # Triggered by another device. The run starts, and each wait ends, on a rising edge of its trigger
+            clock_times, clock_value = np.asarray(clock[0]), np.asarray(clock[1]).astype(np.int64)
+            clock_indices = np.where((clock_value[1:] - clock_value[:-1]) == 1)[0] + 1
+            if clock_value[0] == 1:
+                clock_indices = np.insert(clock_indices, 0, 0)
+            trigger_times = clock_times[clock_indices]
+
+        # Maps the program (in clock cycles, not counting time waiting) to the shot (in seconds)
+        timing = SegmentTiming(wait_ends, program.end_time, self.clock_resolution, trigger_times, self.trigger_delay, self.wait_delay)
 
         clocklines_and_triggers = {}
         # Start by getting all the direct output devices, but then need to do any additional clocklines
@@ -171,77 +397,22 @@ class NarwhalDevicesPulseGeneratorParser(object):
             direct_output_channel = int(direct_output.parent_port.split()[1])
             print(direct_output_name, direct_output_channel)
             print()
-            direct_output_states = channel_states[:, direct_output_channel]
-            add_trace(direct_output_name, (times, direct_output_states), self.device.name, direct_output.parent_port)
-            # print(vars(direct_output))
-            # print()
-            print('times')
-            print(times)
-            print('states')
-            print(direct_output_states)
-            print()
+            # The trace is only generated (from the state words, where bit n is channel n) when runviewer needs it
+            trace = NarwhalDevicesPulseGeneratorTrace(program, direct_output_channel, timing)
+            add_trace(direct_output_name, trace, self.device.name, direct_output.parent_port)
             if direct_output.device_class == 'Trigger':
-                # Extract only the times when this trigger changes
-                # Find indices where the state changes
-                changes = np.where(np.diff(direct_output_states) != 0)[0]
-                # Add 1 because np.diff gives the index of the first element of the pair where the change occurs
-                indices_to_keep = changes + 1
-                # Always include the first element
-                indices_to_keep = np.insert(indices_to_keep, 0, 0)
-                # Filter the times and states arrays
-                filtered_times = times[indices_to_keep]
-                filtered_direct_output_states = direct_output_states[indices_to_keep]
-                clocklines_and_triggers[direct_output_name] = (filtered_times, filtered_direct_output_states)
+                # The times when this trigger changes time the devices it triggers
+                clocklines_and_triggers[direct_output_name] = trace.edges()
 
         # now do additional clocklines
-
-
-        # print('self.device')
-        # print(self.device.name)
-        # print(vars(self.device))
-
-
-        # print('self.device.child_list')
-        # print(self.device.child_list) # A dictionary of pseudoclocks (the actual speudoclock and the dummy waitmonitor one)
-
-        # connection_NDPG0_pseudoclock = self.device.child_list['NDPG0_pseudoclock']
-
-        # # print('connection_NDPG0_pseudoclock')       
-        # # print(connection_NDPG0_pseudoclock)        
-        # # print(vars(connection_NDPG0_pseudoclock))
-        
-        # NDPG0_direct_output_clock_line = connection_NDPG0_pseudoclock.child_list['NDPG0_direct_output_clock_line']
-
-        # # print('NDPG0_direct_output_clock_line')        
-        # # print(NDPG0_direct_output_clock_line)        
-        # # print(vars(NDPG0_direct_output_clock_line))
-        
-        # NDPG0_direct_output_device = NDPG0_direct_output_clock_line.child_list['NDPG0_direct_output_device']
-        
-        # print('NDPG0_direct_output_device')
-        # # print(NDPG0_direct_output_device)
-        # print(vars(NDPG0_direct_output_device))
-
-        # NDPG0_DO0 = NDPG0_direct_output_device.child_list['NDPG0_DO0']
-        
-        # print('NDPG0_DO0')
-        # # print(NDPG0_DO0)
-        # print(vars(NDPG0_DO0))
-
-        # test_trigger = NDPG0_direct_output_device.child_list['test_trigger']
-        
-        # print('test_trigger')
-        # # print(NDPG0_DO0)
-        # print(vars(test_trigger))
-
-        # physical_connection = NDPG0_DO0.parent_port
-        # print('hoop')
-        # print(physical_connection)
-
-        # add_trace(name, trace, parent_device_name, connection)
-        
-        # clocklines_and_triggers = {}
-        # return np.array(durations, dtype=int), np.array(states, dtype=int), np.array(instruction_address, dtype=int), np.array(goto_counter, dtype=int), np.array(goto_counter_original, dtype=int), np.array(stop_and_wait, dtype=bool), np.array(hard_trig_out, dtype=bool), np.array(notify_computer, dtype=bool), np.array(powerline_sync, dtype=bool)
+        for clock_line_name, clock_line in pseudoclock.child_list.items():
+            if clock_line.parent_port == 'internal':
+                # The direct outputs, done above
+                continue
+            clock_line_channel = int(clock_line.parent_port.split()[1])
+            clock_line_trace = NarwhalDevicesPulseGeneratorTrace(program, clock_line_channel, timing).edges()
+            clocklines_and_triggers[clock_line_name] = clock_line_trace
+            add_trace(clock_line_name, clock_line_trace, self.device.name, clock_line.parent_port)
 
         print('clocklines_and_triggers')
         print(clocklines_and_triggers)
@@ -0,0 +1,94 @@
+'''
+Checks that the runviewer parser's PulseProgramTree, which finds edges and execution times by tiling one repetition of
+each hardware loop, agrees with stepping through every executed instruction like the Pulse Generator does
+(runviewer_parsers.walk_addresses), on many random programs with nested (and some non-nesting) loops.
+
+Run from the userlib directory, with pytest or on its own (exits non-zero if any check fails):
+    python -m user_devices.NarwhalDevicesPulseGenerator.test_runviewer_parsers
+'''
+import unittest
+
+import numpy as np
+
+from user_devices.NarwhalDevicesPulseGenerator.labscript_devices import NarwhalDevicesPulseGenerator
+from user_devices.NarwhalDevicesPulseGenerator.runviewer_parsers import PulseProgramTree, find_loops, walk_addresses
+
+
+def random_pulse_program(rng, n_instructions, nesting=True):
+    '''A random PULSE_PROGRAM with loops nested up to three deep, and small goto_counters so that it can be stepped
+    through. If nesting is False, a loop that overlaps another one (without nesting in it) is added.'''
+    pulse_program = np.zeros(n_instructions, dtype=NarwhalDevicesPulseGenerator.pulse_program_dtype)
+    pulse_program['address'] = np.arange(n_instructions)
+    # Only a few channels, so that some instructions don't change them
+    pulse_program['state'] = rng.integers(0, 8, size=n_instructions)
+    pulse_program['duration'] = rng.integers(1, 6, size=n_instructions)
+    pulse_program['stop_and_wait'] = rng.random(n_instructions) < 0.1
+
+    def add_loops(first, last, depth):
+        address = first
+        while address <= last:
+            if depth < 3 and rng.random() < 0.3:
+                end = int(rng.integers(address, last + 1))
+                pulse_program['goto_address'][end] = address
+                pulse_program['goto_counter'][end] = rng.integers(1, 4)
+                # A loop inside this one can't end on the same instruction
+                add_loops(address, end - 1, depth + 1)
+                address = end + 1
+            else:
+                address += 1
+
+    # The final instruction is never the end of a loop
+    add_loops(0, n_instructions - 2, 0)
+    if not nesting:
+        start, middle, end = np.sort(rng.choice(n_instructions - 1, size=3, replace=False))
+        pulse_program['goto_counter'][:] = 0
+        pulse_program['goto_address'][middle], pulse_program['goto_counter'][middle] = start, 1
+        pulse_program['goto_address'][end], pulse_program['goto_counter'][end] = start + 1, 1
+    return pulse_program
+
+
+def reference_edges(pulse_program, channel):
+    '''The times at which channel changes, and the values it changes to (starting with its value at time 0), found by
+    stepping through every executed instruction.'''
+    addresses = walk_addresses(pulse_program)
+    values = ((pulse_program['state'][addresses] >> channel) & 1).astype(np.int8)
+    times = np.concatenate(([0], np.cumsum(pulse_program['duration'][addresses])[:-1]))
+    changes = np.concatenate(([0], np.flatnonzero(values[1:] != values[:-1]) + 1))
+    return times[changes], values[changes]
+
+
+class PulseProgramTreeTest(unittest.TestCase):
+    n_trials = 300
+
+    def random_pulse_programs(self, seed, nesting=True):
+        rng = np.random.default_rng(seed)
+        for trial in range(self.n_trials):
+            yield trial, random_pulse_program(rng, int(rng.integers(2 if nesting else 4, 40)), nesting)
+
+    def check_program(self, trial, pulse_program):
+        tree = PulseProgramTree(pulse_program)
+        addresses = walk_addresses(pulse_program)
+        self.assertEqual(tree.end_time, pulse_program['duration'][addresses].sum(), f'trial {trial}: end_time differs')
+        for channel in range(3):
+            times, values = tree.edges(channel)
+            reference_times, reference_values = reference_edges(pulse_program, channel)
+            np.testing.assert_array_equal(times, reference_times, err_msg=f'trial {trial}: channel {channel} edge times differ')
+            np.testing.assert_array_equal(values, reference_values, err_msg=f'trial {trial}: channel {channel} edge values differ')
+        times, rows = tree.execution_times(pulse_program['stop_and_wait'])
+        start_times = np.concatenate(([0], np.cumsum(pulse_program['duration'][addresses])[:-1]))
+        waits = pulse_program['stop_and_wait'][addresses]
+        np.testing.assert_array_equal(times, start_times[waits], err_msg=f'trial {trial}: execution times differ')
+        np.testing.assert_array_equal(rows, addresses[waits], err_msg=f'trial {trial}: executed rows differ')
+
+    def test_nested_loops(self):
+        for trial, pulse_program in self.random_pulse_programs(0):
+            self.check_program(trial, pulse_program)
+
+    def test_loops_that_do_not_nest(self):
+        for trial, pulse_program in self.random_pulse_programs(1, nesting=False):
+            self.assertIsNone(find_loops(pulse_program), f'trial {trial}: the loops nest')
+            self.check_program(trial, pulse_program)
+
+
+if __name__ == '__main__':
+    unittest.main()
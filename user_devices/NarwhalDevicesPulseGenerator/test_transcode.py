@@ -0,0 +1,76 @@
+'''
+Checks that transcode.encode_instructions gives exactly the same bytes as ndpulsegen.encode_instruction (which is what
+the Pulse Generator firmware is written against), and that transcode.decode_instructions undoes it, on many random
+pulse programs. No hardware is needed.
+
+Run from the userlib directory, with pytest or on its own (exits non-zero if any check fails):
+    python -m user_devices.NarwhalDevicesPulseGenerator.test_transcode
+'''
+import unittest
+
+import numpy as np
+import ndpulsegen
+
+from user_devices.NarwhalDevicesPulseGenerator.labscript_devices import NarwhalDevicesPulseGenerator
+from user_devices.NarwhalDevicesPulseGenerator.transcode import encode_instructions, decode_instructions, instruction_fields, instruction_tags
+
+
+def random_pulse_program(rng, n_instructions):
+    '''A random (but valid) PULSE_PROGRAM. Each integer field is drawn from its full range, with the edges of the range
+    (where a byte slicing mistake would show up) heavily over-represented.'''
+    pulse_program = np.zeros(n_instructions, dtype=NarwhalDevicesPulseGenerator.pulse_program_dtype)
+    for name, n_bytes, minimum, maximum in instruction_fields:
+        if name == 'address':
+            continue
+        values = rng.integers(minimum, maximum, size=n_instructions, endpoint=True, dtype=np.int64)
+        edges = np.array([minimum, minimum + 1, maximum - 1, maximum] + [min(max(2**(8*k) + d, minimum), maximum) for k in range(1, n_bytes) for d in (-1, 0)])
+        use_edge = rng.random(n_instructions) < 0.3
+        values[use_edge] = rng.choice(edges, size=use_edge.sum())
+        pulse_program[name] = values
+    pulse_program['address'] = rng.permutation(8192)[:n_instructions] if n_instructions <= 8192 else np.arange(n_instructions) % 8192
+    for name, bit in instruction_tags:
+        pulse_program[name] = rng.random(n_instructions) < 0.5
+    # ndpulsegen.encode_instruction doesn't allow this combination
+    pulse_program['powerline_sync'][pulse_program['address'] == 0] = False
+    return pulse_program
+
+
+def reference_encode(pulse_program):
+    '''Encodes each instruction individually with ndpulsegen, as the BLACS worker used to.'''
+    return b''.join([ndpulsegen.encode_instruction(address=int(instruction['address']), duration=int(instruction['duration']),
+                                                   state=int(instruction['state']), goto_address=int(instruction['goto_address']),
+                                                   goto_counter=int(instruction['goto_counter']), stop_and_wait=bool(instruction['stop_and_wait']),
+                                                   hardware_trig_out=bool(instruction['hardware_trig_out']), notify_computer=bool(instruction['notify_computer']),
+                                                   powerline_sync=bool(instruction['powerline_sync'])) for instruction in pulse_program])
+
+
+class TranscodeTest(unittest.TestCase):
+    n_trials = 200
+
+    def random_pulse_programs(self, seed):
+        rng = np.random.default_rng(seed)
+        for trial in range(self.n_trials):
+            yield rng, trial, random_pulse_program(rng, int(rng.integers(1, 300)))
+
+    def test_encode_matches_ndpulsegen(self):
+        for rng, trial, pulse_program in self.random_pulse_programs(0):
+            self.assertEqual(encode_instructions(pulse_program).tobytes(), reference_encode(pulse_program), f'trial {trial}: encoded bytes differ')
+
+    def test_encode_rejects_out_of_range(self):
+        for rng, trial, pulse_program in self.random_pulse_programs(1):
+            # Push one field of one instruction out of range. Both encoders must refuse it.
+            name, n_bytes, minimum, maximum = instruction_fields[rng.integers(len(instruction_fields))]
+            pulse_program[name][rng.integers(len(pulse_program))] = minimum - 1 if (rng.random() < 0.5 and name != 'state') else maximum + 1
+            for encode in [encode_instructions, reference_encode]:
+                with self.assertRaises(ValueError, msg=f'trial {trial}: {encode.__name__} accepted an out of range {name}'):
+                    encode(pulse_program)
+
+    def test_decode_inverts_encode(self):
+        for rng, trial, pulse_program in self.random_pulse_programs(2):
+            decoded = decode_instructions(encode_instructions(pulse_program))
+            for name in [field[0] for field in instruction_fields] + [tag[0] for tag in instruction_tags]:
+                np.testing.assert_array_equal(decoded[name], pulse_program[name], err_msg=f'trial {trial}: {name} differs after decoding')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,123 @@
+import numpy as np
+
+#########################################################
+# encode
+
+load_ram_identifier = 151
+'''The message identifier of a load_ram (instruction) message. See ndpulsegen.transcode.msgout_identifier'''
+
+instruction_message_dtype = np.dtype([('identifier', np.uint8), ('address', np.uint8, 2), ('state', np.uint8, 3), ('duration', np.uint8, 6),
+                                      ('goto_address', np.uint8, 2), ('goto_counter', np.uint8, 4), ('tags', np.uint8)])
+'''Byte level view of a single encoded instruction message. It has no padding, so an array of these is exactly the buffer that
+is uploaded to the Pulse Generator.'''
+
+# (name, number of bytes, minimum, maximum) of each integer field of an instruction. The limits are the same as ndpulsegen.encode_instruction
+instruction_fields = [('address', 2, 0, 8191), ('state', 3, 0, 16777215), ('duration', 6, 1, 281474976710655),
+                      ('goto_address', 2, 0, 8191), ('goto_counter', 4, 0, 4294967295)]
+
+# Bit position of each tag in the tags byte
+instruction_tags = [('stop_and_wait', 0), ('hardware_trig_out', 1), ('notify_computer', 2), ('powerline_sync', 3)]
+
+
+def encode_instructions(pulse_program):
+    ''' Vectorised version of ndpulsegen.encode_instruction, which encodes every instruction in the pulse_program
+    structured array (see NarwhalDevicesPulseGenerator.pulse_program_dtype) at once. The output state is taken from
+    pulse_program['state'], so any unspecified channels must already have been filled in (or masked off).
+    Returns a (len(pulse_program), instruction_message_dtype.itemsize) uint8 array, where each row is byte-for-byte
+    what ndpulsegen.encode_instruction returns for that instruction.
+
+    Messageout identifier:  1 byte: 151
+    Message format:                             BITS USED   FPGA INDEX.
+    instruction_address:        2 bytes [0:2]   16 bits     [0+:16]     uint.
+    main_outputs_state:         3 bytes [2:5]   24 bits     [16+:24]    uint.
+    instruction_duration:       6 bytes [5:11]  48 bits     [40+:48]    uint.
+    goto_address:               2 bytes [11:13] 16 bits     [88+:16]    uint.
+    goto_counter:               4 bytes [13:17] 32 bits     [104+:32]   uint.
+    tags:                       1 byte  [17]    4 bits      [136+:4]    uint.
+        stop_and_wait                           1 bit       [136]
+        hardware_trigger_out                    1 bits      [137]
+        notify_instruction_activated            1 bit       [138]
+        powerline_sync                          1 bit       [139]
+    '''
+    messages = np.empty(len(pulse_program), dtype=instruction_message_dtype)
+    messages['identifier'] = load_ram_identifier
+    for name, n_bytes, minimum, maximum in instruction_fields:
+        values = pulse_program[name]
+        out_of_range = (values < minimum) | (values > maximum)
+        if out_of_range.any():
+            address = pulse_program['address'][np.argmax(out_of_range)]
+            raise ValueError(f'\'{name}\' of the instruction at address {address} out of range. Must be in range [{minimum}, {maximum}]')
+        # Little endian, so the field is the first n_bytes bytes of the 8 byte value
+        messages[name] = values.astype('<u8').view(np.uint8).reshape(-1, 8)[:, :n_bytes]
+    invalid_powerline_sync = (pulse_program['address'] == 0) & pulse_program['powerline_sync']
+    if invalid_powerline_sync.any():
+        raise ValueError('Instruction at address=0 cannot have powerline_sync=True. The run would start automatically.')
+    tags = np.zeros(len(pulse_program), dtype=np.uint8)
+    for name, bit in instruction_tags:
+        tags |= pulse_program[name].astype(np.uint8) << bit
+    messages['tags'] = tags
+    return messages.view(np.uint8).reshape(len(pulse_program), instruction_message_dtype.itemsize)
+
+
+def decode_instructions(encoded_instructions):
+    ''' The inverse of encode_instructions. Decodes a buffer of encoded instruction messages (bytes, or any array of
+    them) into a dict of arrays, with one entry for each field in instruction_fields and each tag in instruction_tags.'''
+    messages = np.frombuffer(bytes(encoded_instructions), dtype=instruction_message_dtype)
+    if (messages['identifier'] != load_ram_identifier).any():
+        raise ValueError('Not every message is a load_ram (instruction) message')
+    decoded = {}
+    for name, n_bytes, minimum, maximum in instruction_fields:
+        # Little endian, so pad the field out to 8 bytes to read it as a single value
+        padded = np.zeros((len(messages), 8), dtype=np.uint8)
+        padded[:, :n_bytes] = messages[name].reshape(len(messages), n_bytes)
+        decoded[name] = padded.view('<u8').ravel().astype(np.int64)
+    for name, bit in instruction_tags:
+        decoded[name] = ((messages['tags'] >> bit) & 1).astype(bool)
+    return decoded
+
+
+#########################################################
+# waits
+
+wait_addresses_dtype = [('start_address', np.int64), ('end_address', np.int64), ('start_duration', np.int64)]
+'''One row per wait: the address of the stop_and_wait instruction that the wait starts after (and its duration), 
+and the address of the instruction that is executed when the wait ends.'''
+
+def find_wait_addresses(pulse_program):
+    ''' Finds the start and end addresses of every wait in the pulse_program, in the order they happen (which is the
+    order of the labscript wait table). Returns a structured array with dtype wait_addresses_dtype.'''
+    waits = pulse_program[pulse_program['stop_and_wait']]
+    wait_addresses = np.zeros(len(waits), dtype=wait_addresses_dtype)
+    wait_addresses['start_address'] = waits['address']
+    wait_addresses['start_duration'] = waits['duration']
+    # The wait ends on the next instruction, unless the stop_and_wait instruction loops back, in which case it ends on the goto_address
+    wait_addresses['end_address'] = np.where(waits['goto_counter'] == 0, waits['address'] + 1, waits['goto_address'])
+    return wait_addresses
+
+
+#########################################################
+# notifications
+
+notification_dtype = [('timestamp', np.float64), ('address', np.int64), ('flags', np.uint8), ('run_time', np.int64)]
+'''One row per notification sent by the Pulse Generator: the host time it was received (seconds since the epoch), the 
+address being executed, which notify tags were set (see notification_flags), and the run_time (in 10ns clock cycles).'''
+
+# Bit position of each notify tag in the flags byte. These are the same as the tags byte of the notification message.
+notification_flags = [('address_notify', 0), ('trigger_notify', 1), ('finished_notify', 2)]
+
+def pack_notification_flags(notification):
+    '''The notify tags of a decoded notification (as returned by ndpulsegen) packed into a flags byte.'''
+    flags = 0
+    for name, bit in notification_flags:
+        flags |= bool(notification[name]) << bit
+    return flags
+
+def unpack_notifications(notifications):
+    '''Converts rows of a notification_dtype array back into the dicts that ndpulsegen returns, so they can be displayed.'''
+    unpacked = []
+    for timestamp, address, flags, run_time in notifications.tolist():
+        notification = {'timestamp': timestamp, 'address': address, 'run_time': run_time}
+        for name, bit in notification_flags:
+            notification[name] = bool((flags >> bit) & 1)
+        unpacked.append(notification)
+    return unpacked